@@ -0,0 +1,96 @@
+"Compares per-node and per-level model layouts, on training and prediction time."
+from argparse import ArgumentParser, SUPPRESS
+from copy import deepcopy
+from json import load
+from os import path, walk
+from time import perf_counter
+from rich import print
+from rich.table import Table
+from rich.traceback import install
+from Bio import SeqIO
+from workspace.create_database import build_database
+from workspace.create_model import attach_models, model_nodes, train_models
+from workspace.create_prediction import batch_prediction
+from workspace.taxonomy import routing_tables
+
+
+def best_family(results: str | list) -> str | None:
+    "Family most reads of a sequence have been assigned to, if any"
+    families: dict = {family: count for counter in results[-1].values()
+                      for family, count in counter.items()} if isinstance(results, list) else {}
+    return max(families, key=families.__getitem__) if families else None
+
+
+def benchmark_layouts(params_file: str, database_name: str, references_folder: str, reads_file: str, threads: int) -> None:
+    """Learns both model layouts over the same database, and predicts the same reads with each of them
+
+    Args:
+        params_file (str): path to parameters file
+        database_name (str): name for database
+        references_folder (str): folder containing reference genomes
+        reads_file (str): fasta file of reads to predict
+        threads (int): number of cores
+    """
+    database_path, phylo_tree = build_database(
+        params_file,
+        database_name,
+        [path.abspath(path.join(dirpath, f)) for dirpath, _, filenames in walk(
+            references_folder) for f in filenames],
+        threads
+    )
+    nodes_per_level: dict = routing_tables(phylo_tree).nodes_per_level(
+        ['root', 'domain', 'phylum', 'group', 'order'])
+    with open(params_file, 'r', encoding='utf-8') as pfile:
+        params: dict = load(pfile)
+    with open(reads_file, 'r', encoding='utf-8') as freader:
+        reads: dict = {fasta.id: str(fasta.seq)
+                       for fasta in SeqIO.parse(freader, 'fasta')}
+
+    table: Table = Table(title=f"Model layouts over {len(reads)} reads")
+    for column in ['Layout', 'Models', 'Training (s)', 'Prediction (ms/read)', 'Same family as node layout']:
+        table.add_column(column)
+    families: dict[str, list] = dict()
+    for layout in ['node', 'level']:
+        start: float = perf_counter()
+        retcodes: list = train_models(
+            database_path, fargs := model_nodes(nodes_per_level, layout), threads)
+        training_time: float = perf_counter() - start
+        tree = attach_models(deepcopy(phylo_tree),
+                             nodes_per_level, fargs, retcodes)
+
+        start = perf_counter()
+        families[layout] = [best_family(results) for results in batch_prediction(
+            reads, params, routing_tables(tree), params['threshold'], params_file).values()]
+        prediction_time: float = perf_counter() - start
+
+        table.add_row(
+            layout,
+            str(len(fargs)),
+            f"{training_time:.2f}",
+            f"{1000 * prediction_time / max(len(reads), 1):.1f}",
+            f"{sum(a == b for a, b in zip(families['node'], families[layout])) / max(len(reads), 1):.1%}"
+        )
+    print(table)
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(add_help=False)
+    parser.add_argument('-h', '--help', action='help', default=SUPPRESS,
+                        help='Compare per-node and per-level model layouts')
+    parser.add_argument(
+        "params_file", type=str, help="Path to parameters file.")
+    parser.add_argument(
+        "references_folder", type=str, help="Folder containing reference genomes.")
+    parser.add_argument(
+        "reads_file", type=str, help="Fasta file of reads to predict.")
+    parser.add_argument("-d", "--database", help="Name for database",
+                        required=False, type=str, default='benchmark_layouts')
+    parser.add_argument("-t", "--threads", help="Number of cores",
+                        required=False, type=int, default=1)
+    args = parser.parse_args()
+
+    install(show_locals=True)
+
+    benchmark_layouts(args.params_file, args.database,
+                      args.references_folder, args.reads_file, args.threads)
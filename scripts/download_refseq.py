@@ -1,5 +1,6 @@
 "Download genomes from NCBI."
 from os import system
+from gzip import open as gzip_open
 from argparse import ArgumentParser, SUPPRESS
 from rich.traceback import install
 from Bio import SeqIO, Entrez
@@ -25,11 +26,11 @@ def download_from_ncbi(summary_file: str, genomes_path: str, email: str, start:
                     https_wget = [
                         elt for elt in split if elt.startswith('https')][0]
                     access = [split[0], https_wget]
-                    # Downloading genome file
+                    # Downloading genome file, kept compressed as wisp reads gzipped fasta
                     system(
-                        f"wget -P {genomes_path} {access[1][8:]}/{access[1][8:].split('/')[-1]}_genomic.fna.gz && gzip -d {genomes_path}/{access[1][8:].split('/')[-1]}_genomic.fna.gz")
+                        f"wget -P {genomes_path} {access[1][8:]}/{access[1][8:].split('/')[-1]}_genomic.fna.gz")
                     # Extracting
-                    with open((file_path := f"{genomes_path}/{access[1][8:].split('/')[-1]}_genomic.fna"), "r", encoding='utf-8') as reader:
+                    with gzip_open((file_path := f"{genomes_path}/{access[1][8:].split('/')[-1]}_genomic.fna.gz"), "rt", encoding='utf-8') as reader:
                         accession: str = reader.readline().split('.')[0][1:]
 
                     # Get taxonomy from NCBI taxonomy
@@ -43,7 +44,7 @@ def download_from_ncbi(summary_file: str, genomes_path: str, email: str, start:
                                 order = e
                         if order:
                             group = classif[2] if classif[2][-4:] != 'ales' else classif[1]
-                            file_name: str = f"{genomes_path}/{classif[0]}_{classif[1]}_{group}_{order}_{sub.split(' ')[0]}_{sub.split(' ')[1]}.fna"
+                            file_name: str = f"{genomes_path}/{classif[0]}_{classif[1]}_{group}_{order}_{sub.split(' ')[0]}_{sub.split(' ')[1]}.fna.gz"
                             system(f"mv {file_path} {file_name}")
                         else:
                             # we clean genomes we can't retrive classification for
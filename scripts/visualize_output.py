@@ -1,16 +1,15 @@
 "Aims to display results in a Sankey graph"
-from pickle import load as pload
 from json import load as jload
 from argparse import ArgumentParser, SUPPRESS
 from pathlib import Path
 from os import path
 from random import choice
 from rich.traceback import install
-from treelib import Tree
 from tharospytools import get_palette
 from plotly import graph_objects as go
 from dash import Dash, dcc, html
 from warnings import filterwarnings
+from workspace.taxonomy import read_taxonomy
 
 
 def dash_app(fig, fig2, job_name: str = 'Job report'):
@@ -49,11 +48,11 @@ def plot_report(phylo_path: str, json_report: str, output_path: str, reads_per_s
         reads_per_sample (int, optional): _description_. Defaults to 500.
     """
 
-    with open(phylo_path, 'rb') as jtree:
-        tree: Tree = pload(jtree)
+    taxonomy: dict = read_taxonomy(phylo_path)
+    nodes: list[str] = [f"{name}_{depth}" for name, depth in zip(
+        taxonomy['names'].tolist(), taxonomy['depths'].tolist())]
 
-    mappings_taxa: dict = {
-        f"{node.tag}_{tree.depth(node)}": i for i, node in enumerate(tree.all_nodes_itr())}
+    mappings_taxa: dict = {node: i for i, node in enumerate(nodes)}
     inv_map = {v: k for k, v in mappings_taxa.items()}
 
     with open(json_report, 'r', encoding='utf-8') as jreader:
@@ -120,7 +119,7 @@ def plot_report(phylo_path: str, json_report: str, output_path: str, reads_per_s
                             valuesuffix="%")
 
     mappings_ancestors: dict = {
-        f"{node.tag}_{tree.depth(node)}": f"{tree.get_node(tree.ancestor(node.identifier)).tag}_{tree.depth(node)-1}" for i, node in enumerate(tree.all_nodes_itr()) if tree.depth(node) > 0
+        node: nodes[parent] for node, parent in zip(nodes, taxonomy['parents'].tolist()) if parent >= 0
     }
     mappings_ancestors["REJECTED"] = "Root_0"
     sunburst_points: list[str] = [
@@ -181,7 +180,7 @@ if __name__ == '__main__':
 
     parser = ArgumentParser(add_help=False)
     parser.add_argument(
-        "taxonomy", type=str, help="Path to wisp taxonomy tree.")
+        "taxonomy", type=str, help="Path to wisp taxonomy file.")
     parser.add_argument('-h', '--help', action='help', default=SUPPRESS,
                         help='Creates a html report of reads repartition')
     parser.add_argument(
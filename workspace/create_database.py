@@ -1,65 +1,26 @@
-"Creates a json database"
-from collections import Counter
+"Creates a binary database"
 from json import load, dumps
-from os import path, remove
+from hashlib import sha256
+from os import path, getpid, replace
 from pathlib import Path
-from typing import Generator
-from itertools import product
-from dataclasses import dataclass
-from Bio import SeqIO
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import cpu_count
+from numpy import ndarray, zeros, savez, load as npload
 from treelib import Tree
 from treelib.exceptions import DuplicatedNodeIdError
-from tharospytools import revcomp
-
-
-@dataclass
-class Taxonomy:
-    "Modelizes a taxa level"
-    code: int | None
-    level: str
-    name: str
-    model_path: str | None
-    config_path: str | None
-
-
-def validate_parameters(params: dict) -> bool:
-    "Lists all conditions where a set of parameters is valid, and accepts the creation if so"
-    return all(
-        [
-            # verifies that the pattern length respects ksize
-            sum(params['pattern']) == params['ksize'],
-        ]
-    )
-
-
-def encoder(ksize: int) -> dict:
-    """Generates a dict of codes for kmers
-
-    Args:
-        ksize (int): length of kmer
+from workspace.kmer_counting import count_features, feature_space, validate_parameters
+from workspace.fasta_reader import genome_codes
+from workspace.kmer_database import DatabaseWriter, count_dtype, sparse_rows
+from workspace.taxonomy import Taxonomy, routing_tables
 
-    Returns:
-        dict: kmer:code
-    """
-    return {code: encode_kmer(code) for code in map(''.join, product('ATCG', repeat=ksize))}
 
-
-def encode_kmer(kmer: str) -> int:
-    """Encodes a kmer into base 4 format
-
-    Args:
-        kmer (str): a k-sized word composed of A,T,C,G
-
-    Returns:
-        int: Encoding of kmer
-    """
-    mapper: dict = {
-        'A': "0",
-        'C': "1",
-        'G': "2",
-        'T': "3",
-    }
-    return int(''.join([mapper[k] for k in kmer]))
+# Parameters the windows counts of a genome depend on
+FEATURE_PARAMETERS: tuple[str, ...] = (
+    'ksize', 'pattern', 'read_size', 'sampling', 'canonical', 'n_policy')
+# Bumped whenever the way genomes are counted changes, invalidating cached counts
+CACHE_VERSION: int = 2
 
 
 def taxonomy_information(genome_path: str, tree_struct: Tree) -> tuple[dict, Tree]:
@@ -89,8 +50,93 @@ def taxonomy_information(genome_path: str, tree_struct: Tree) -> tuple[dict, Tre
     }, tree_struct
 
 
-def build_database(params_file: str, database_name: str, input_data: list[str]) -> tuple[str, Tree]:
-    "Builds a json file with taxa levels as dict information"
+def genome_key(genome_path: str, params: dict) -> str:
+    """Content address of the windows of a genome
+
+    Args:
+        genome_path (str): fasta file of the genome
+        params (dict): featurization parameters
+
+    Returns:
+        str: hash of the file contents and of the parameters the counts depend on
+    """
+    digest = sha256(dumps({'version': CACHE_VERSION, **{key: params.get(key)
+                    for key in FEATURE_PARAMETERS}}, sort_keys=True).encode())
+    with open(genome_path, 'rb') as freader:
+        while chunk := freader.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def featurize_genome(genome_path: str, params: dict, cache_dir: str | None = None) -> tuple[str, tuple[ndarray, ndarray, ndarray] | None]:
+    """Reads a reference genome and counts kmers inside each of its windows
+
+    Args:
+        genome_path (str): fasta or fasta.gz file of the genome
+        params (dict): featurization parameters
+        cache_dir (str | None, optional): folder of already counted genomes. Defaults to None.
+
+    Returns:
+        tuple[str, tuple[ndarray, ndarray, ndarray] | None]: key of the genome (see genome_key),
+            and CSR pieces of the windows, None if genome is shorter than a window
+    """
+    key: str = genome_key(genome_path, params)
+    if cache_dir is not None:
+        # Genomes that did not change since last build are read back from cache
+        if path.exists(cache_file := path.join(cache_dir, f"{key}.npz")):
+            with npload(cache_file) as cached:
+                windows: tuple = (cached['row_sizes'],
+                                  cached['indices'], cached['counts'])
+            return key, windows if len(windows[0]) else None
+
+    # Contigs are kept apart, so that no kmer is made up across their junctions
+    codes: ndarray = genome_codes(genome_path)
+
+    # Splitting of reads, too short genomes are cached with no windows
+    windows: tuple = sparse_rows(
+        count_features(codes, params),
+        count_dtype(params)
+    ) if len(codes) >= params['read_size'] else sparse_rows(zeros((0, 0)), count_dtype(params))
+
+    if cache_dir is not None:
+        # Written aside then renamed, so that an interrupted build leaves no partial block
+        with open(partial_file := f"{cache_file}.{getpid()}.tmp", 'wb') as cwriter:
+            savez(cwriter, row_sizes=windows[0],
+                  indices=windows[1], counts=windows[2])
+        replace(partial_file, cache_file)
+    return key, windows if len(windows[0]) else None
+
+
+def featurized_genomes(input_data: list[str], params: dict, num_processes: int, cache_dir: str | None = None) -> Iterator[tuple[str, str, tuple | None]]:
+    """Fans genomes out to a process pool, and yields their windows in input order
+
+    At most twice as many genomes as workers are in flight, so that memory
+    stays bounded while the writer catches up.
+
+    Args:
+        input_data (list[str]): fasta files of the genomes
+        params (dict): featurization parameters
+        num_processes (int): number of workers
+        cache_dir (str | None, optional): folder of already counted genomes. Defaults to None.
+
+    Yields:
+        Iterator[tuple[str, str, tuple | None]]: genome path, its key and its windows, see featurize_genome
+    """
+    with ProcessPoolExecutor(max_workers=num_processes) as executor:
+        in_flight: deque[tuple[str, Future]] = deque()
+        for genome in input_data:
+            in_flight.append(
+                (genome, executor.submit(featurize_genome, genome, params, cache_dir)))
+            if len(in_flight) >= 2 * num_processes:
+                genome_path, future = in_flight.popleft()
+                yield genome_path, *future.result()
+        while in_flight:
+            genome_path, future = in_flight.popleft()
+            yield genome_path, *future.result()
+
+
+def build_database(params_file: str, database_name: str, input_data: list[str], num_processes: int = cpu_count()) -> tuple[str, Tree]:
+    "Builds a memory-mappable database of windows counts, with taxa levels as labels"
     # Loading params file
     with open(params_file, 'r', encoding='utf-8') as pfile:
         params: dict = load(pfile)
@@ -99,75 +145,38 @@ def build_database(params_file: str, database_name: str, input_data: list[str])
     if not validate_parameters(params):
         raise RuntimeError("Incorrect parameter file")
 
-    # creating encoder
-    my_encoder: dict = encoder(ksize=params['ksize'])
-
     # creating phylogenetic tree
     phylo_tree: Tree = Tree()
     phylo_tree.create_node(
         'Root', 'root_root', data=Taxonomy(0, 'Root', 'Root', None, None))
 
     # Writing the database
-    json_datas: list = list()
-    Path(f"{path.dirname(__file__)}/databases/").mkdir(parents=True, exist_ok=True)
-    with open(output_path := f'{path.dirname(__file__)}/databases/{database_name}.json', 'w', encoding='utf-8') as jdb:
-        jdb.write("{\n")
-        jdb.write("\"datas\":[")
-
-        # iterating over input genomes
-        for id_genome, genome in enumerate(input_data):
-            with open(genome, 'r', encoding='utf-8') as freader:
-                genome_data: list = [str(fasta.seq)
-                                     for fasta in SeqIO.parse(freader, 'fasta')]
-                # Merging all seqs together
-                dna_sequence = (''.join([seq for seq in genome_data])).upper()
-
-            # Splitting of reads
-            if len(dna_sequence) >= params['read_size']:
-                all_reads = splitting(
-                    dna_sequence,
-                    params['read_size'],
-                    params['sampling']
-                )
-                # Counting kmers inside each read
-                counters: list[Counter] = [
-                    counter(
-                        read,
-                        params['ksize'],
-                        params['pattern']
-                    ) for read in all_reads
-                ]
-                del all_reads
-
-                # Encoding reads for XGBoost
-                encoded: list = [{my_encoder[k]:v for k, v in cts.items()}
-                                 for cts in counters]
-                del counters
-
-                # Dumping in output file
-                taxonomy, phylo_tree = taxonomy_information(
-                    genome, phylo_tree)
-
-                if id_genome:
-                    jdb.write(','+dumps({**taxonomy, 'datas': encoded}))
-                else:
-                    jdb.write(dumps({**taxonomy, 'datas': encoded}))
-
-                del encoded
-
-            if 'taxonomy' in locals():
-                json_datas.append({**taxonomy})
-            del genome_data
-
-        # Writing taxonomy to file
-        jdb.write("],\"mappings\": ")
-        jdb.write(dumps(taxa_codes := mapping_sp(json_datas)))
-        jdb.write("\n}")
-
-        for i, level in enumerate(['root', 'domain', 'phylum', 'group', 'order', 'family']):
-            for node in list(phylo_tree.filter_nodes(lambda x: phylo_tree.depth(x) == i)):
-                if node.data.code is None:
-                    node.data.code = taxa_codes[level][node.tag]
+    database: DatabaseWriter = DatabaseWriter(
+        f'{path.dirname(__file__)}/databases/{database_name}',
+        params,
+        feature_space(params)
+    )
+
+    # Counts of each genome are kept, so that a rebuild only counts new or changed genomes
+    Path(cache_dir := f'{path.dirname(__file__)}/databases/cache').mkdir(
+        parents=True, exist_ok=True)
+
+    # iterating over input genomes, a single writer keeps the order of input files
+    for genome, key, windows in featurized_genomes(input_data, params, num_processes, cache_dir):
+        if windows is not None:
+            # Dumping in output files
+            taxonomy, phylo_tree = taxonomy_information(
+                genome, phylo_tree)
+            database.add_genome(genome, taxonomy, windows, key)
+
+    # Writing taxonomy to file
+    output_path: str = database.close(
+        taxa_codes := mapping_sp(database.genomes))
+
+    for taxa, level in zip(routing_tables(phylo_tree).taxa, ['root', 'domain', 'phylum', 'group', 'order', 'family']):
+        for name, taxonomy in taxa.items():
+            if taxonomy.code is None:
+                taxonomy.code = taxa_codes[level][name]
 
     return output_path, phylo_tree
 
@@ -196,132 +205,3 @@ def mapping_sp(datas: list[dict]) -> dict:
                     taxa_level[value] = taxa_level['number_taxa']
                     taxa_level['number_taxa'] += 1
     return taxa_codes
-
-
-def splitting(seq: str, window_size: int, max_sampling: int) -> Generator:
-    """Splits a lecture into subreads
-
-    Args:
-        seq (str): a DNA sequence
-        window_size (int): size of splits
-        max_sampling (int): maximum number of samples inside lecture
-
-    Raises:
-        ValueError: if read is too short
-
-    Yields:
-        Generator: subreads collection
-    """
-    if len(seq) < window_size:
-        raise ValueError("Read is too short.")
-    shift: int = int((len(seq)-window_size)/max_sampling)
-    for i in range(max_sampling):
-        yield seq[shift*i:shift*i+window_size]
-
-
-def pattern_filter(substring: str, pattern: list[int]) -> str:
-    """Applies a positional filter over a string
-
-    Args:
-        substring (str): substring to clean
-        pattern (list): integers to be multiplied by
-
-    Returns:
-        str: a cleaned kmer
-    """
-    return ''.join([char * pattern[i] for i, char in enumerate(substring)])
-
-
-def counter(entry: str, kmer_size: int, pattern: list[int]) -> Counter:
-    """Counts all kmers and filter non-needed ones
-
-    Args:
-        entry (str): a subread
-        kmer_size (int): k size
-        pattern (list[int]): 110110... pattern, to select specific chars in kmer
-
-    Returns:
-        Counter: counts of kmers inside subread
-    """
-    # Defining custom complementarity
-    complements: dict = {
-        'A': 'T',
-        'T': 'A',
-        'C': 'G',
-        'G': 'C',
-        'U': 'A',
-        'R': 'Y',
-        'Y': 'R',
-        'K': 'M',
-        'M': 'K',
-        'S': 'W',
-        'W': 'S',
-        'B': 'V',
-        'V': 'B',
-        'D': 'H',
-        'H': 'D',
-        'N': 'N'
-    }
-
-    all_kmers: Generator = (entry[i:i+len(pattern)]
-                            for i in range(len(entry)-len(pattern)-1))
-    counts: Counter = Counter(all_kmers)
-    rev_counts: Counter = Counter(
-        {revcomp(k, compl=complements): v for k, v in counts.items()})
-    counts += rev_counts
-    del rev_counts
-    if not all(pattern):
-        # All positions in pattern should not be kept, we apply filter
-        counts = Counter({pattern_filter(k, pattern): v for k, v in counts.items()})
-    for filtered_kmer in (alpha * kmer_size for alpha in ['A', 'T', 'C', 'G']):
-        if filtered_kmer in counts:
-            del counts[filtered_kmer]
-    # We treat cases where sequence alphabet is not ATCG
-    counts_purged: dict = {}
-    for key, count in counts.items():
-        list_of_keys: list = list()
-        splitted_key: list = [*key]
-        for x in splitted_key:
-            if x in ['A', 'T', 'C', 'G']:
-                nuct: list = [x]
-            elif x == 'U':
-                nuct: list = ['T']
-            elif x == 'R':
-                nuct: list = ['G', 'A']
-            elif x == 'Y':
-                nuct: list = ['C', 'T']
-            elif x == 'K':
-                nuct: list = ['G', 'T']
-            elif x == 'M':
-                nuct: list = ['A', 'C']
-            elif x == 'S':
-                nuct: list = ['G', 'C']
-            elif x == 'W':
-                nuct: list = ['A', 'T']
-            elif x == 'B':
-                nuct: list = ['G', 'T', 'C']
-            elif x == 'D':
-                nuct: list = ['G', 'T', 'A']
-            elif x == 'H':
-                nuct: list = ['A', 'T', 'C']
-            elif x == 'V':
-                nuct: list = ['G', 'A', 'C']
-            else:
-                nuct: list = ['A', 'T', 'C', 'G']
-            # Adding to the keys
-            # If list empty
-            if len(list_of_keys) == 0:
-                list_of_keys = nuct
-            else:
-                list_of_keys = [
-                    new_key+n for n in nuct for new_key in list_of_keys]
-        # Updating counts to stay with only ATGC counts
-        for prob_key in list_of_keys:
-            kmer_number: int = count//len(list_of_keys)
-            if prob_key in counts_purged:
-                counts_purged[prob_key] += kmer_number
-            else:
-                counts_purged[prob_key] = kmer_number
-    del counts
-    # We divide count by the number of keys we end up with to normalize
-    return Counter(counts_purged)
@@ -1,20 +1,369 @@
 "Creates the XGB models"
 from os import path, remove
 from pathlib import Path
-from typing import Any
+from tempfile import TemporaryDirectory
+from collections.abc import Callable
 from copy import copy
-from xgboost import Booster, config_context, DMatrix, train
+from json import dump, dumps, load, JSONDecodeError
+from hashlib import sha256
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from multiprocessing import cpu_count
+from numpy import ndarray, arange, array, concatenate, int64, sort, zeros, load as npload, save as npsave
+from numpy.random import default_rng
+from xgboost import Booster, config_context, DataIter, DMatrix, train
 from xgboost.core import XGBoostError
+from treelib import Tree
+from workspace.kmer_database import Database, load_database
+from workspace.taxonomy import column_map_path
+
+# Database mapped once by each training worker, see attach_database
+WORKER_DATABASE: dict[str, Database] = dict()
+
+
+def attach_database(database_path: str) -> None:
+    """Pool initializer, memory-maps the database once per worker process
+
+    Counts are shared between workers through the page cache, so that tasks
+    only carry the node they train on.
+
+    Args:
+        database_path (str): folder written by build_database
+    """
+    WORKER_DATABASE['database'] = load_database(database_path)
+
+
+def make_node_model(model_name: str, classification_level: str, target_dataset: str | None, nthread: int | None = None) -> tuple[str | None, str | None]:
+    "Builds the model of a taxon node, from the database attached to the worker"
+    return make_model(WORKER_DATABASE['database'], model_name, classification_level, target_dataset, nthread=nthread)
+
+
+def lower_level(classification_level: str) -> str:
+    "Level a model of the given level has to classify into"
+    return (levels := ["root", "domain", "phylum", "group", "order", "family", "specie"])[
+        (levels).index(classification_level)+1]
+
+
+def node_rows(datas: Database, classification_level: str, target_dataset: str | None) -> ndarray:
+    """Windows the model of a node learns from, read from the taxonomy index
+
+    Args:
+        datas (Database): database the model learns from
+        classification_level (str): level of the node
+        target_dataset (str | None): taxon of the node, None for the model of the whole level
+
+    Returns:
+        ndarray: sorted rows
+    """
+    if classification_level == 'root' or target_dataset is None:
+        return arange(datas.number_rows)
+    return datas.taxon_rows(classification_level, target_dataset)
+
+
+def node_name(classification_level: str, target_dataset: str | None) -> str:
+    "Prefix of the files of a node model"
+    return f"{classification_level}_level" if target_dataset is None else f"{target_dataset}_{classification_level}"
+
+
+def model_nodes(nodes_per_level: dict[str, list[str]], layout: str = 'node') -> list[tuple[str, str | None]]:
+    """Lists the models to learn for a taxonomy
+
+    Args:
+        nodes_per_level (dict[str, list[str]]): taxa of each level
+        layout (str, optional): 'node' for a model per taxon classifying into its children,
+            'level' for a model per level classifying into all taxa of the level below. Defaults to 'node'.
+
+    Raises:
+        ValueError: if layout is unknown
+
+    Returns:
+        list[tuple[str, str | None]]: level and taxon of each model, no taxon for a model of the whole level
+    """
+    match layout:
+        case 'node':
+            return [(level, taxon) for level, taxa in nodes_per_level.items() for taxon in taxa]
+        case 'level':
+            return [(level, None) for level in nodes_per_level]
+        case _:
+            raise ValueError(f"Unknown model layout {layout}.")
+
+
+def attach_models(tree: Tree, nodes_per_level: dict[str, list[str]], nodes: list[tuple[str, str | None]], models: list[tuple[str | None, str | None]]) -> Tree:
+    """Stores in the taxonomy where the model of each node lies
+
+    Args:
+        tree (Tree): taxonomy tree built along the database
+        nodes_per_level (dict[str, list[str]]): taxa of each level
+        nodes (list[tuple[str, str | None]]): level and taxon of each model, see model_nodes
+        models (list[tuple[str | None, str | None]]): model and config paths of each model, see train_models
+
+    Returns:
+        Tree: the taxonomy tree
+    """
+    for (taxonomic_level, target_taxa), (model_path, config_path) in zip(nodes, models):
+        if model_path is not None and config_path is not None:
+            # A model spanning a whole level is shared by all nodes of the level
+            for target in nodes_per_level[taxonomic_level] if target_taxa is None else [target_taxa]:
+                try:
+                    node = tree[f"{target.lower()}_{taxonomic_level}"]
+                    node.data.model_path = model_path
+                    node.data.config_path = config_path
+                except KeyError:
+                    tree.remove_node(target.lower())
+    return tree
+
+
+def node_cost(datas: Database, classification_level: str, target_dataset: str | None) -> int:
+    """Estimates how long the model of a node takes to train
+
+    Args:
+        datas (Database): database the model learns from
+        classification_level (str): level of the node
+        target_dataset (str | None): taxon of the node, None for the model of the whole level
+
+    Returns:
+        int: number of windows times number of classes of the model
+    """
+    return len(node_rows(datas, classification_level, target_dataset)) * datas.mappings[lower_level(classification_level)]['number_taxa']
+
+
+def train_models(database_path: str, nodes: list[tuple[str, str | None]], num_cores: int = cpu_count()) -> list[tuple[str | None, str | None]]:
+    """Trains the models of many nodes, sharing cores between processes and XGBoost threads
+
+    Largest jobs start first, each with a number of threads proportional to its
+    share of the total cost, so that the root model, the longest one, is not
+    left alone at the end. No more threads than cores are ever running.
+
+    Args:
+        database_path (str): folder written by build_database
+        nodes (list[tuple[str, str | None]]): level and taxon of each node, no taxon for a model of the whole level
+        num_cores (int, optional): available cores. Defaults to cpu_count().
+
+    Returns:
+        list[tuple[str | None, str | None]]: model and config paths of each node, in the order of nodes
+    """
+    # Header is parsed once, every node cost reads the same mapped labels
+    datas: Database = load_database(database_path)
+    costs: list[int] = [node_cost(datas, level, taxon)
+                        for level, taxon in nodes]
+    total_cost: int = max(sum(costs), 1)
+    pending: deque[int] = deque(
+        sorted(range(len(nodes)), key=lambda job: costs[job], reverse=True))
+    results: list[tuple[str | None, str | None]] = [(None, None)] * len(nodes)
+    running: dict[Future, tuple[int, int]] = dict()
+    free_cores: int = num_cores
+    with ProcessPoolExecutor(max_workers=num_cores, initializer=attach_database, initargs=(database_path,)) as executor:
+        while pending or running:
+            while pending and free_cores:
+                job: int = pending.popleft()
+                threads: int = max(
+                    1, min(free_cores, round(num_cores * costs[job] / total_cost)))
+                running[executor.submit(
+                    make_node_model, database_path, *nodes[job], threads)] = (job, threads)
+                free_cores -= threads
+            # Cores are given back as soon as any job ends
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                job, threads = running.pop(future)
+                free_cores += threads
+                results[job] = future.result()
+    return results
+
+
+class DatabaseBatches(DataIter):
+    "Feeds XGBoost with batches of windows, read one after the other from the memory-mapped database"
+
+    def __init__(self, datas: Database, rows: ndarray, label_level: str, batch_size: int, cache_prefix: str, columns: ndarray | None = None) -> None:
+        self.datas: Database = datas
+        self.rows: ndarray = rows
+        self.columns: ndarray | None = columns
+        self.label_level: str = label_level
+        self.batch_size: int = batch_size
+        self.position: int = 0
+        super().__init__(cache_prefix=cache_prefix)
+
+    def next(self, input_data: Callable) -> bool:
+        "Passes the next batch to XGBoost, returns False once all windows have been seen"
+        if self.position >= len(self.rows):
+            return False
+        batch: ndarray = self.rows[self.position:self.position+self.batch_size]
+        input_data(
+            data=self.datas.rows(batch, self.columns),
+            label=self.datas.labels[self.label_level][batch]
+        )
+        self.position += self.batch_size
+        return True
+
+    def reset(self) -> None:
+        "Goes back to the first batch"
+        self.position = 0
+
+
+def training_matrix(datas: Database, rows: ndarray, label_level: str, batch_size: int | None, cache_prefix: str, columns: ndarray | None = None, nthread: int | None = None) -> DMatrix:
+    """Builds the matrix a model learns on, in memory or as external memory pages
+
+    Args:
+        datas (Database): database the model learns from
+        rows (ndarray): windows to learn on
+        label_level (str): level labels are read from
+        batch_size (int | None): number of windows per batch, None to hold all of them in memory
+        cache_prefix (str): where external memory pages are written
+        columns (ndarray | None, optional): features to learn on. Defaults to None (all of them).
+        nthread (int | None, optional): threads building the matrix. Defaults to None (all cores).
+
+    Raises:
+        RuntimeError: if external memory is asked for with a XGBoost release older than 3.0
+
+    Returns:
+        DMatrix: training matrix
+    """
+    if batch_size is None:
+        # Only those windows are read, straight into a matrix spanning the whole feature space
+        return DMatrix(datas.rows(rows, columns), label=datas.labels[label_level][rows], nthread=nthread)
+    # Only needed, and only shipped from XGBoost 3.0 on, when external memory is configured
+    try:
+        from xgboost import ExtMemQuantileDMatrix
+    except ImportError as exc:
+        raise RuntimeError(
+            "Training from external memory needs XGBoost 3.0 or later, remove 'external_memory' from parameter file or upgrade XGBoost.") from exc
+    return ExtMemQuantileDMatrix(DatabaseBatches(datas, rows, label_level, batch_size, cache_prefix, columns), nthread=nthread)
+
+
+def important_features(bst: Booster, number_features: int) -> ndarray:
+    """Selects the features carrying most of the gain of a model
+
+    Args:
+        bst (Booster): model learnt on the whole feature space
+        number_features (int): maximum number of features to keep
+
+    Returns:
+        ndarray: sorted feature indexes, features never used by a split are never kept
+    """
+    scores: dict[str, float] = bst.get_score(importance_type='gain')
+    best: list[str] = sorted(scores, key=scores.__getitem__,
+                             reverse=True)[:number_features]
+    return sort(array([int(name[1:]) for name in best], dtype=int64))
+
+
+def node_manifest(
+        datas: Database,
+        classification_level: str,
+        target_dataset: str | None,
+        model_parameters: dict,
+        num_rounds_boosting: int,
+        batch_size: int | None
+) -> dict | None:
+    """Lists all that the model of a node is learnt from
+
+    Rows are identified by the content address of the genomes they come from,
+    so that the manifest does not need to read any count.
+
+    Args:
+        datas (Database): database the model learns from
+        classification_level (str): level of the node
+        target_dataset (str | None): taxon of the node, None for the model of the whole level
+        model_parameters (dict): XGBoost parameters
+        num_rounds_boosting (int): number of boosting rounds
+        batch_size (int | None): external memory batch size
+
+    Returns:
+        dict | None: genomes with their labels, label mapping and hash of parameters, None if genomes are not content addressed
+    """
+    next_level: str = lower_level(classification_level)
+    genomes: list[list] = [[genome['key'], genome[next_level]]
+                           for genome in node_genomes(datas, classification_level, target_dataset)]
+    if any(key is None for key, _ in genomes):
+        return None
+    return {
+        'genomes': genomes,
+        'mappings': datas.mappings[next_level],
+        'settings': sha256(dumps(
+            {
+                # Threads change how fast a model is learnt, not what is learnt
+                'parameters': {key: value for key, value in model_parameters.items() if key != 'nthread'},
+                'num_rounds_boosting': num_rounds_boosting,
+                'batch_size': batch_size,
+                'features': datas.features,
+                'feature_pruning': datas.header['params'].get('feature_pruning')
+            },
+            sort_keys=True
+        ).encode()).hexdigest()
+    }
+
+
+def node_genomes(datas: Database, classification_level: str, target_dataset: str | None) -> list[dict]:
+    "Genomes of the database a node model is learnt from"
+    return [genome for genome in datas.header['genomes']
+            if classification_level == 'root' or target_dataset is None or genome[classification_level] == target_dataset]
+
+
+def fingerprint_of(manifest: dict) -> str:
+    "Hash of a manifest, equal for models learnt from the same rows, labels and parameters"
+    return sha256(dumps(manifest, sort_keys=True).encode()).hexdigest()
+
+
+def read_manifest(manifest_path: str) -> dict | None:
+    "Manifest of the last time a node has been learnt, None if it never was"
+    if not path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r', encoding='utf-8') as mreader:
+        try:
+            return load(mreader)
+        except JSONDecodeError:
+            # Bare fingerprints of older builds can't be compared, node will be learnt again
+            return None
+
+
+def can_warm_start(previous: dict, manifest: dict) -> bool:
+    """Tells if a model may keep on boosting rather than being learnt again
+
+    Trees already grown stay valid as long as parameters and classes are the same,
+    and no genome has been removed or labelled otherwise : only new genomes are allowed.
+
+    Args:
+        previous (dict): manifest the model has been learnt with
+        manifest (dict): manifest of the current database
+
+    Returns:
+        bool: if boosting may continue from the previous model
+    """
+    previous_genomes: set = {tuple(genome) for genome in previous['genomes']}
+    current_genomes: set = {tuple(genome) for genome in manifest['genomes']}
+    return previous['settings'] == manifest['settings'] and previous['mappings'] == manifest['mappings'] and previous_genomes < current_genomes
+
+
+def update_rows(datas: Database, genomes: list[dict], known_keys: set, reservoir: float) -> ndarray:
+    """Rows a model is updated on : all windows of new genomes, and a sample of the ones already learnt
+
+    Args:
+        datas (Database): database the model learns from
+        genomes (list[dict]): genomes of the node
+        known_keys (set): keys of the genomes the model already learnt from
+        reservoir (float): ratio of already learnt windows mixed in, so that new trees do not forget them
+
+    Returns:
+        ndarray: sorted rows
+    """
+    def genome_rows(new: bool) -> ndarray:
+        return concatenate([zeros(0, dtype=int64)] + [arange(genome['first_row'], genome['first_row']+genome['number_rows'])
+                                                      for genome in genomes if (genome['key'] not in known_keys) == new])
+    known_rows: ndarray = genome_rows(False)
+    return sort(concatenate([
+        genome_rows(True),
+        default_rng(0).choice(known_rows, size=int(
+            reservoir * len(known_rows)), replace=False)
+    ]))
 
 
 def make_model(
-        datas: Any,
+        datas: Database,
         model_name: str,
         classification_level: str,
-        target_dataset: str,
+        target_dataset: str | None,
         num_rounds_boosting: int = 10,
         eta: float = 0.3,
-        maximum_depth: int = 10
+        maximum_depth: int = 10,
+        nthread: int | None = None
 ) -> tuple[str | None, str | None]:
     "Builds the model and saves it"
     # Creating the booster
@@ -25,14 +374,13 @@ def make_model(
         predictor='cpu_predictor'
     )
 
-    next_level: str = (levels := ["root", "domain", "phylum", "group", "order", "family", "specie"])[
-        (levels).index(classification_level)+1]
+    next_level: str = lower_level(classification_level)
 
-    if not classification_level in datas['mappings'] and not classification_level == 'root':
+    if not classification_level in datas.mappings and not classification_level == 'root':
         raise ValueError(
             f"Database does not contain {classification_level} level.")
 
-    mappings: dict = copy(datas['mappings'][next_level])
+    mappings: dict = copy(datas.mappings[next_level])
     try:
         number_taxa: int = mappings.pop('number_taxa')
     except KeyError:
@@ -47,43 +395,94 @@ def make_model(
         'eta': eta,
         'eval_metric': 'mlogloss'
     }
+    if nthread is not None:
+        model_parameters['nthread'] = nthread
+    # Levels listed in params are learnt by batches of windows, memory being bounded by the batch size
+    if (batch_size := datas.header['params'].get('external_memory', dict()).get(classification_level)) is not None:
+        model_parameters['tree_method'] = 'hist'
+
+    # We create the dir to store the database
+    Path(model_dir := f"{path.dirname(__file__)}/model/{Path(model_name).stem}").mkdir(
+        parents=True, exist_ok=True)
+    model_output_path: str = f"{model_dir}/{node_name(classification_level, target_dataset)}.json"
+    config_output_path: str = f"{model_dir}/{node_name(classification_level, target_dataset)}_params.json"
+
+    # A model learnt from the same rows, labels and parameters is kept as is, so that builds resume where they stopped
+    manifest: dict | None = node_manifest(
+        datas, classification_level, target_dataset, model_parameters, num_rounds_boosting, batch_size)
+    previous: dict | None = read_manifest(
+        manifest_path := f"{model_dir}/{node_name(classification_level, target_dataset)}.fingerprint")
+    has_model: bool = path.exists(
+        model_output_path) and path.exists(config_output_path)
+    if manifest is not None and previous is not None and has_model:
+        if previous.get('fingerprint') == fingerprint_of(manifest):
+            return model_output_path, config_output_path
+
     try:
-        # We will be creating temporary LibSVM files in order to make our model learn on those,
-        # then destroy files in order to save space
-        Path(temp_dir :=
-             f"{path.dirname(__file__)}/tmp").mkdir(parents=True, exist_ok=True)
-
-        # We create the dir to store the database
-        Path(model_dir := f"{path.dirname(__file__)}/model/{Path(model_name).stem}").mkdir(
-            parents=True, exist_ok=True)
-
-        # We create temporary files
-        with open(temp_dataset := f"{temp_dir}/{target_dataset}_{classification_level}.txt", 'w', encoding='utf-8') as libsvm_writer:
-            for sample in datas['datas']:
-                if classification_level == 'root' or sample[classification_level] == target_dataset:
-                    # Sample should be kept for model
-                    for read in sample['datas']:
-                        # Each read is a dict with code:count for kmer
-                        libsvm_writer.write(
-                            f"{mappings[sample[next_level]]} {' '.join([str(k)+':'+str(v) for k,v in read.items()])} #{sample[next_level]}\n")
-
-        # Creating the model
-        bst: Booster = train(
-            model_parameters,
-            DMatrix(temp_dataset),
-            num_rounds_boosting
-        )
+        # Windows to learn on are a slice of the taxonomy index, without reading counts
+        rows: ndarray = node_rows(
+            datas, classification_level, target_dataset)
+        base_model: str | None = None
+
+        # When genomes have only been added, boosting goes on from the model on new windows
+        if (warm_start := datas.header['params'].get('warm_start')) and manifest is not None and previous is not None and has_model and can_warm_start(previous, manifest):
+            rows = update_rows(
+                datas,
+                node_genomes(datas, classification_level, target_dataset),
+                {key for key, _ in previous['genomes']},
+                warm_start.get('reservoir', 0.0)
+            )
+            base_model = model_output_path
+            num_rounds_boosting = warm_start.get(
+                'rounds', num_rounds_boosting)
+
+        # An updated model keeps on learning from the features it has been pruned to
+        columns: ndarray | None = npload(column_map_path(model_output_path)) if base_model is not None and path.exists(
+            column_map_path(model_output_path)) else None
+
+        # Creating the model, external memory pages being dropped along with the cache folder
+        with TemporaryDirectory(prefix=f"{node_name(classification_level, target_dataset)}_") as cache_dir:
+            bst: Booster = train(
+                model_parameters,
+                training_matrix(datas, rows, next_level,
+                                batch_size, path.join(cache_dir, 'cache'), columns, nthread),
+                num_rounds_boosting,
+                xgb_model=base_model
+            )
+
+            # Pruning : model is learnt again on the kmers carrying most of the gain, and predicts from them only
+            if (pruning := datas.header['params'].get('feature_pruning')) and base_model is None:
+                if len(columns := important_features(bst, pruning['features'])):
+                    bst = train(
+                        model_parameters,
+                        training_matrix(datas, rows, next_level,
+                                        batch_size, path.join(cache_dir, 'pruned'), columns, nthread),
+                        num_rounds_boosting
+                    )
+                else:
+                    columns = None
+
+        # Column map of a pruned model lies next to it, a model learnt on all features has none
+        if columns is not None:
+            npsave(column_map_path(model_output_path), columns)
+        elif path.exists(column_map_path(model_output_path)):
+            remove(column_map_path(model_output_path))
+
+        # Stamping the model with the kmer features it has been trained on, and if it spans a whole level
+        bst.set_attr(features=dumps(datas.features),
+                     layout='node' if target_dataset is not None else 'level')
 
         # Saving the model and its params
         # Must go to model_dir
-        bst.save_model(model_output_path :=
-                       f"{model_dir}/{target_dataset}_{classification_level}.json")
+        bst.save_model(model_output_path)
 
-        with open(config_output_path := f"{model_dir}/{target_dataset}_{classification_level}_params.json", 'w', encoding='utf-8') as jwriter:
+        with open(config_output_path, 'w', encoding='utf-8') as jwriter:
             jwriter.write(bst.save_config())
 
-        # Destroying the temporary directory and its contents
-        remove(temp_dataset)
+        # Manifest comes last, marking the node as done
+        if manifest is not None:
+            with open(manifest_path, 'w', encoding='utf-8') as mwriter:
+                dump({**manifest, 'fingerprint': fingerprint_of(manifest)}, mwriter)
 
         # Returning the target file
         return model_output_path, config_output_path
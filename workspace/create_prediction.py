@@ -1,42 +1,135 @@
 "Builds predictions from reads"
-from os import remove
-from collections import Counter
+from os import path
+from collections import Counter, OrderedDict
+from json import loads
 from xgboost import Booster, DMatrix
-from numpy import argmax, amax, mean, ndarray
-from treelib import Tree
-from workspace.create_sample import build_sample
+from numpy import arange, argmax, amax, concatenate, cumsum, ndarray, split, load as npload
+from scipy.sparse import csr_matrix
+from workspace.create_sample import build_batch
+from workspace.kmer_counting import feature_space
+from workspace.taxonomy import Routing, Taxonomy, column_map_path, load_taxonomy
 
+# Memory budget of the boosters kept by a prediction worker, in megabytes
+MODEL_CACHE_SIZE: int = 1024
+# Boosters loaded by this worker, by model path, least recently used first, with their column map and size
+WORKER_BOOSTERS: OrderedDict[str, tuple[Booster, ndarray | None, int]] = OrderedDict()
+# Boosters of the upper levels, asked for by every read, are never evicted
+PINNED_BOOSTERS: dict[str, tuple[Booster, ndarray | None]] = dict()
+# Taxonomy loaded once by each prediction worker, see attach_taxonomy
+WORKER_ROUTING: dict[str, Routing] = dict()
+
+
+def attach_taxonomy(taxonomy_path: str) -> None:
+    """Pool initializer, loads the taxonomy once per worker process
+
+    Tasks then only carry their batch of reads.
+
+    Args:
+        taxonomy_path (str): file written by save_taxonomy
+    """
+    WORKER_ROUTING['routing'] = load_taxonomy(taxonomy_path)
 
-def make_prediction(
-        model_path: str,
-        parameters_path: str,
-        datas_path: str,
-        normalisation_func: str,
-        read_identity_threshold: float
-) -> list:
-    """Does a prediction with a pre-calculated model
+
+def cached_booster(model_path: str, parameters_path: str, pinned: bool = False, cache_size: int = MODEL_CACHE_SIZE) -> tuple[Booster, ndarray | None]:
+    """Loads a model once per worker, and keeps it for the next reads
 
     Args:
         model_path (str): full path to model
-        parameters_path (str): _description_
-        datas_path (str): _description_
-        normalisation_func (str): _description_
-        read_identity_threshold (float): _description_
+        parameters_path (str): full path to model config
+        pinned (bool, optional): if model should never be evicted. Defaults to False.
+        cache_size (int, optional): memory budget of unpinned models, in megabytes. Defaults to MODEL_CACHE_SIZE.
 
     Returns:
-        list: _description_
+        tuple[Booster, ndarray | None]: the model, ready to predict, and the features it reads if it has been pruned
     """
+    if (loaded := PINNED_BOOSTERS.get(model_path)) is not None:
+        return loaded
+    if model_path in WORKER_BOOSTERS:
+        WORKER_BOOSTERS.move_to_end(model_path)
+        bst, columns, _ = WORKER_BOOSTERS[model_path]
+        return bst, columns
 
-    # Creating booster object
-    bst: Booster = Booster()
+    bst = Booster()
     bst.load_model(model_path)
     with open(parameters_path, "r", encoding='utf-8') as reader:
         bst.load_config(''.join([line for line in reader]))
+    # Pruned models only read the kmers they have been learnt on
+    columns: ndarray | None = npload(columns_path) if path.exists(
+        columns_path := column_map_path(model_path)) else None
+
+    if pinned:
+        PINNED_BOOSTERS[model_path] = (bst, columns)
+        return bst, columns
+    # Size on disk of the json model is an upper bound of the booster footprint
+    WORKER_BOOSTERS[model_path] = (bst, columns, path.getsize(
+        model_path) + (columns.nbytes if columns is not None else 0))
+    while len(WORKER_BOOSTERS) > 1 and sum(size for _, _, size in WORKER_BOOSTERS.values()) > cache_size * 2**20:
+        WORKER_BOOSTERS.popitem(last=False)
+    return bst, columns
+
+
+def score_windows(
+        model_path: str,
+        parameters_path: str,
+        sample: csr_matrix,
+        features: dict,
+        pinned: bool = False,
+        cache_size: int = MODEL_CACHE_SIZE,
+        nthread: int | None = None
+) -> tuple[ndarray, bool]:
+    """Scores windows, held in memory, with a pre-calculated model
+
+    Args:
+        model_path (str): full path to model
+        parameters_path (str): full path to model config
+        sample (csr_matrix): kmer counts, one row per window
+        features (dict): description of the kmer features of the sample
+        pinned (bool, optional): if model should stay loaded for the whole run. Defaults to False.
+        cache_size (int, optional): memory budget of the worker models, in megabytes. Defaults to MODEL_CACHE_SIZE.
+        nthread (int | None, optional): threads the model predicts with. Defaults to None (as configured).
+
+    Raises:
+        ValueError: if model has been trained on other features than the sample ones
+
+    Returns:
+        tuple[ndarray, bool]: probability of each class for each window, and if model spans a whole level
+    """
+    # Booster and its column map are read from disk only the first time this worker needs them
+    bst, columns = cached_booster(
+        model_path, parameters_path, pinned, cache_size)
+
+    # Canonical and non-canonical features can't be mixed up
+    if (model_features := bst.attr('features')) is not None and loads(model_features) != features:
+        raise ValueError(
+            f"Model {model_path} was trained on other kmer features than the sample ones.")
 
-    # Getting predictions
-    predictions: ndarray = bst.predict(DMatrix(datas_path))
+    if columns is not None:
+        sample = sample[:, columns]
 
-    return softmax(predictions, normalisation_func, read_identity_threshold)
+    # Getting predictions, with no more threads than this worker is given
+    if nthread is not None:
+        bst.set_param({'nthread': nthread})
+    return bst.predict(DMatrix(sample, nthread=nthread)), bst.attr('layout') == 'level'
+
+
+def masked_prediction(predictions: ndarray, classes: list[int], normalisation_func: str, read_identity_threshold: float) -> list:
+    """Does a prediction restricted to some classes, from the scores of a model spanning a whole level
+
+    Args:
+        predictions (ndarray): probability of each class for each window
+        classes (list[int]): codes of the children of the taxon being explored
+        normalisation_func (str): the function used to discriminate reads
+        read_identity_threshold (float): between 0 and 1
+
+    Returns:
+        list: a class for each read, among the given ones
+    """
+    if not classes:
+        return []
+    # Models of a single class give a single score per window
+    kept: ndarray = predictions.reshape(len(predictions), -1)[:, classes]
+    # Scores are normalized again over the kept classes, as if a model of the node had been asked
+    return [classes[p] if p is not False else False for p in softmax(kept / kept.sum(axis=1, keepdims=True), normalisation_func, read_identity_threshold)]
 
 
 def softmax(predictions: ndarray, func: str, reads_threshold: float) -> list:
@@ -63,14 +156,17 @@ def softmax(predictions: ndarray, func: str, reads_threshold: float) -> list:
     try:
         match func:
             case 'delta_mean':
-                ret: list = [argmax(a) if amax(a)-mean(a) >
-                             reads_threshold else False for a in predictions]
+                # Evaluated for all windows at once, models of a single class giving a single score per window
+                scores: ndarray = predictions.reshape(len(predictions), -1)
+                ret: list = [best if kept else False for best, kept in zip(scores.argmax(axis=1).tolist(), (
+                    scores.max(axis=1)-scores.mean(axis=1) > reads_threshold).tolist())]
             case 'min_max':
                 ret: list = [argmax(a) if min([amax(a)-p for p in a if p != amax(a)]) >
                              reads_threshold else False for a in predictions]
             case 'delta_sum':
-                ret: list = [argmax(a) if amax(a) > (sum(a)-amax(a)) + reads_threshold
-                             else False for a in predictions]
+                scores: ndarray = predictions.reshape(len(predictions), -1)
+                ret: list = [best if kept else False for best, kept in zip(scores.argmax(axis=1).tolist(), (
+                    scores.max(axis=1) > (scores.sum(axis=1)-scores.max(axis=1)) + reads_threshold).tolist())]
             case _:
                 ret: list = [argmax(a) for a in predictions]
     except ValueError:
@@ -85,51 +181,142 @@ def softmax(predictions: ndarray, func: str, reads_threshold: float) -> list:
         return softmax(predictions, func, reads_threshold-0.05)
 
 
-def prediction(id_sequence: str, dna_sequence: str, params: dict, tree: Tree, threshold: float, parameters: str) -> str | list:
+def routed_scores(
+        model_path: str,
+        parameters_path: str,
+        sample: csr_matrix,
+        offsets: ndarray,
+        reads: list[int],
+        features: dict,
+        pinned: bool = False,
+        cache_size: int = MODEL_CACHE_SIZE,
+        nthread: int | None = None
+) -> tuple[dict[int, ndarray], bool]:
+    """Scores the windows of a subset of reads of a batch with a single model call
+
+    Args:
+        model_path (str): full path to model
+        parameters_path (str): full path to model config
+        sample (csr_matrix): windows of all the reads of the batch
+        offsets (ndarray): offset of the first window of each read
+        reads (list[int]): indexes of the reads routed to this model
+        features (dict): description of the kmer features of the sample
+        pinned (bool, optional): if model should stay loaded for the whole run. Defaults to False.
+        cache_size (int, optional): memory budget of the worker models, in megabytes. Defaults to MODEL_CACHE_SIZE.
+        nthread (int | None, optional): threads the model predicts with. Defaults to None (as configured).
+
+    Returns:
+        tuple[dict[int, ndarray], bool]: scores of the windows of each read, and if model spans a whole level
+    """
+    rows: ndarray = concatenate(
+        [arange(offsets[read], offsets[read+1]) for read in reads])
+    predictions, is_level_model = score_windows(
+        model_path, parameters_path, sample[rows], features, pinned, cache_size, nthread)
+    return dict(zip(reads, split(predictions, cumsum([offsets[read+1]-offsets[read] for read in reads])[:-1]))), is_level_model
+
+
+def batch_prediction(reads: dict[str, str], params: dict, routing: Routing, threshold: float, parameters: str, nthread: int | None = None) -> dict[str, str | list]:
+    """Creates predictions for a batch of reads, level by level.
+
+    Windows of all reads are featurized into a single matrix. At each level, reads are
+    grouped by the taxa they have been kept in, and each model is called once on the
+    windows of the reads routed to it.
+
+    Args:
+        reads (dict[str, str]): DNA sequences, by identifier (fasta header)
+        params (dict): params global dict
+        routing (Routing): routing tables of the taxonomy tree built before
+        threshold (float): threshold to consider a taxa as accurate
+        parameters (str): path to parameters file
+        nthread (int | None, optional): threads each model predicts with. Defaults to None (as configured).
+
+    Returns:
+        dict[str, str | list]: prediction results, by identifier
+    """
+    identifiers: list[str] = [
+        id_sequence for id_sequence, dna_sequence in reads.items() if len(dna_sequence) >= params['read_size']]
+    if not identifiers:
+        return {id_sequence: 'REJECTED' for id_sequence in reads}
+
+    # Creating the sample, once for the whole batch
+    sample, offsets = build_batch(
+        parameters,
+        [reads[id_sequence] for id_sequence in identifiers]
+    )
+    features: dict = feature_space(params)
+    cache_size: int = params.get('model_cache_size', MODEL_CACHE_SIZE)
+
+    # Evaluate at one level
+    results: list[list[dict]] = [[{} for _ in range(5)] for _ in identifiers]
+    kept_taxas: list[list] = [['Root'] for _ in identifiers]
+    for i, _ in enumerate(['root', 'domain', 'phylum', 'group', 'order'], start=0):
+        mappings_taxa: dict[int, str] = routing.names[i+1]
+        level_nodes: dict[str, Taxonomy] = routing.taxa[i]
+        # Reads routed to each taxa of this level
+        routes: dict[str, list[int]] = dict()
+        for read, taxas in enumerate(kept_taxas):
+            for taxa in taxas:
+                routes.setdefault(taxa, []).append(read)
+        # Taxa sharing a model, as all taxa of a level for models spanning whole levels, share a single call
+        routed_models: dict[str, tuple[str, set[int]]] = dict()
+        for tag, routed in routes.items():
+            if (taxa := level_nodes.get(tag)) is not None:
+                _, model_reads = routed_models.setdefault(
+                    taxa.model_path, (taxa.config_path, set()))
+                model_reads.update(routed)
+        level_predictions: dict[str, tuple[dict[int, ndarray], bool]] = {
+            model_path: routed_scores(
+                model_path,
+                config_path,
+                sample,
+                offsets,
+                sorted(model_reads),
+                features,
+                pinned=i < 2,
+                cache_size=cache_size,
+                nthread=nthread
+            ) for model_path, (config_path, model_reads) in routed_models.items()}
+        for tag, routed in routes.items():
+            if (taxa := level_nodes.get(tag)) is None:
+                continue
+            predictions, is_level_model = level_predictions[taxa.model_path]
+            classes: list[int] = routing.children[i][tag]
+            for read in routed:
+                results[read][i][tag] = {mappings_taxa[key]: value for key, value in Counter(
+                    masked_prediction(
+                        predictions[read],
+                        classes,
+                        normalisation_func='delta_mean',
+                        read_identity_threshold=0.8
+                    ) if is_level_model else softmax(
+                        predictions[read],
+                        'delta_mean',
+                        0.8
+                    )).items() if key is not False}
+        kept_taxas = [[lower_taxa for counter in result[i].values(
+        ) for lower_taxa, count in counter.items() if count > threshold*sum(list(counter.values()))] for result in results]
+
+    predicted: dict[str, list] = dict(zip(identifiers, results))
+    return {id_sequence: predicted.get(id_sequence, 'REJECTED') for id_sequence in reads}
+
+
+def worker_prediction(reads: dict[str, str], params: dict, threshold: float, parameters: str) -> dict[str, str | list]:
+    "Creates predictions for a batch of reads, with the taxonomy attached to this worker, on a single thread as the pool spans the cores"
+    return batch_prediction(reads, params, WORKER_ROUTING['routing'], threshold, parameters, nthread=1)
+
+
+def prediction(id_sequence: str, dna_sequence: str, params: dict, routing: Routing, threshold: float, parameters: str) -> str | list:
     """Creates a prediction for a read.
 
     Args:
         id_sequence (str): identifier for sequence (fasta header)
         dna_sequence (str): the full DNA sequence
         params (dict): params global dict
-        tree (Tree): taxonomy tree built before
+        routing (Routing): routing tables of the taxonomy built before
         threshold (float): threshold to consider a taxa as accurate
         parameters (str): path to parameters file
 
     Returns:
         str | list: prediction results
     """
-    if len(dna_sequence) >= params['read_size']:
-        # Creating the sample
-        sample_output_path: str = build_sample(
-            parameters,
-            dna_sequence,
-            id_sequence
-        )
-    else:
-        return 'REJECTED'
-
-    # Evaluate at one level
-    results: list[dict] = [{} for _ in range(5)]
-    kept_taxas: list = ['Root']
-    for i, _ in enumerate(['root', 'domain', 'phylum', 'group', 'order'], start=0):
-        mappings_taxa: dict = {
-            node.data.code: node.tag for node in tree.filter_nodes(lambda x: tree.depth(x) == i+1)}
-        # Use the tree to select next level
-        for taxa in tree.filter_nodes(lambda x: tree.depth(x) == i):
-            if taxa.tag in kept_taxas:
-                # print(f"Processing {taxa.tag} @ {level}")
-                results[i][taxa.tag] = {mappings_taxa[key]: value for key, value in Counter(make_prediction(
-                    taxa.data.model_path,
-                    taxa.data.config_path,
-                    sample_output_path,
-                    normalisation_func='delta_mean',
-                    read_identity_threshold=0.8
-                )).items() if key is not False}
-        kept_taxas = [lower_taxa for counter in results[i].values(
-        ) for lower_taxa, count in counter.items() if count > threshold*sum(list(counter.values()))]
-
-    # Cleaning temp files
-    remove(sample_output_path)
-
-    return results
+    return batch_prediction({id_sequence: dna_sequence}, params, routing, threshold, parameters)[id_sequence]
@@ -0,0 +1,67 @@
+"Reads plain or gzipped fasta files straight into symbol codes"
+from gzip import open as gzip_open
+from collections.abc import Iterator
+from typing import BinaryIO
+from numpy import ndarray, array, concatenate, frombuffer, uint8, zeros
+from workspace.kmer_counting import JUNCTION, SYMBOL_CODES
+
+GZIP_MAGIC: bytes = b'\x1f\x8b'
+
+
+def open_fasta(fasta_path: str) -> BinaryIO:
+    """Opens a fasta file, decompressing it on the fly if gzipped
+
+    Args:
+        fasta_path (str): fasta or fasta.gz file
+
+    Returns:
+        BinaryIO: binary reader over the uncompressed contents
+    """
+    with open(fasta_path, 'rb') as probe:
+        compressed: bool = probe.read(2) == GZIP_MAGIC
+    return gzip_open(fasta_path, 'rb') if compressed else open(fasta_path, 'rb')
+
+
+def read_fasta(fasta_path: str) -> Iterator[tuple[str, ndarray]]:
+    """Streams the records of a fasta file
+
+    Lines of a record are gathered as raw bytes into a buffer reused from one
+    record to the next, then mapped at once to symbol codes : case folding and
+    unknown chars are handled by the table, with no intermediate string.
+
+    Args:
+        fasta_path (str): fasta or fasta.gz file
+
+    Yields:
+        Iterator[tuple[str, ndarray]]: identifier (first word of header) and symbol codes of each record
+    """
+    buffer: bytearray = bytearray()
+    identifier: str | None = None
+    with open_fasta(fasta_path) as freader:
+        for line in freader:
+            if line.startswith(b'>'):
+                if identifier is not None:
+                    yield identifier, SYMBOL_CODES[frombuffer(buffer, dtype=uint8)]
+                identifier = (line[1:].split() or [b''])[0].decode()
+                del buffer[:]
+            elif identifier is not None:
+                buffer += line.rstrip()
+    if identifier is not None:
+        yield identifier, SYMBOL_CODES[frombuffer(buffer, dtype=uint8)]
+
+
+def genome_codes(fasta_path: str) -> ndarray:
+    """Symbol codes of a whole genome, its contigs being separated by junctions
+
+    Args:
+        fasta_path (str): fasta or fasta.gz file
+
+    Returns:
+        ndarray: symbol codes, kmers spanning two contigs are never counted
+    """
+    contigs: list[ndarray] = []
+    for _, codes in read_fasta(fasta_path):
+        if contigs:
+            contigs.append(array([JUNCTION], dtype=uint8))
+        contigs.append(codes)
+    return concatenate(contigs) if contigs else zeros(0, dtype=uint8)
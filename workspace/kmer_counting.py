@@ -0,0 +1,711 @@
+"Counts kmers over DNA sequences using 2-bit integer codes"
+from functools import lru_cache
+from math import prod
+from numpy import ndarray, add, array, arange, argsort, bincount, concatenate, cumsum, diff, flatnonzero, frombuffer, full, int32, int64, isin, lexsort, minimum, repeat, rint, searchsorted, sort, split, uint8, uint64, unique, zeros
+from scipy.sparse import csr_matrix, hstack
+
+# Symbols are ordered so that A, C, G and T are 0, 1, 2 and 3 : a pure kmer reads directly as a 2-bit word.
+# Every other IUPAC letter is ambiguous, and any unknown character is considered as a N.
+ALPHABET: str = 'ACGTRYKMSWBDHVN'
+
+# Case is folded by the table itself, so that sequences never need to be uppercased
+SYMBOL_CODES: ndarray = full(256, ALPHABET.index('N'), dtype=uint8)
+for _code, _symbol in enumerate(ALPHABET):
+    SYMBOL_CODES[ord(_symbol)] = _code
+    SYMBOL_CODES[ord(_symbol.lower())] = _code
+SYMBOL_CODES[ord('U')] = SYMBOL_CODES[ord('u')] = ALPHABET.index('T')
+
+# Placed between contigs of a genome : kmers spanning it stand for no real kmer and are never counted
+JUNCTION: int = len(ALPHABET)
+
+# Custom complementarity, kept identical to the one of the former string-based counter
+COMPLEMENTS: dict = {
+    'A': 'T',
+    'T': 'A',
+    'C': 'G',
+    'G': 'C',
+    'R': 'Y',
+    'Y': 'R',
+    'K': 'M',
+    'M': 'K',
+    'S': 'W',
+    'W': 'S',
+    'B': 'V',
+    'V': 'B',
+    'D': 'H',
+    'H': 'D',
+    'N': 'N'
+}
+COMPLEMENT_CODES: ndarray = array(
+    [ALPHABET.index(COMPLEMENTS[symbol]) for symbol in ALPHABET] + [JUNCTION], dtype=uint8)
+
+# ATCG codes each symbol may stand for, in the same order as the alphabet
+EXPANSIONS: list[ndarray] = [
+    array(['ACGT'.index(nucleotide) for nucleotide in nucleotides], dtype=int64)
+    for nucleotides in ['A', 'C', 'G', 'T', 'AG', 'CT', 'GT', 'AC', 'CG', 'AT', 'CGT', 'AGT', 'ACT', 'ACG', 'ACGT']
+]
+
+# Kmer spaces up to DENSE_RATIO times the number of kmers to count are counted densely with bincount,
+# larger ones by sorting, and no more than DENSE_CELLS dense counts are held at once
+DENSE_RATIO: int = 4
+DENSE_CELLS: int = 1 << 22
+
+# Policies for kmers holding an unknown base (N) : spread over all kmers with floor division as always been,
+# ignore them, or spread them with fractional weights
+N_POLICIES: tuple[str, ...] = ('expand', 'skip', 'split-weight')
+
+
+def encode_kmer(kmer: str) -> int:
+    """Encodes a kmer into its 2-bit code, which is also its feature index
+
+    Args:
+        kmer (str): a k-sized word composed of A,T,C,G
+
+    Returns:
+        int: Encoding of kmer, between 0 and 4^k-1
+    """
+    code: int = 0
+    for char in kmer:
+        code = (code << 2) | 'ACGT'.index(char)
+    return code
+
+
+def decode_kmer(code: int, ksize: int) -> str:
+    """Decodes a 2-bit code back into its kmer
+
+    Args:
+        code (int): Encoding of kmer
+        ksize (int): length of kmer
+
+    Returns:
+        str: a k-sized word composed of A,T,C,G
+    """
+    return ''.join('ACGT'[(code >> 2*(ksize-i-1)) & 3] for i in range(ksize))
+
+
+def sequence_codes(seq: str) -> ndarray:
+    """Maps a DNA sequence to its symbol codes
+
+    Args:
+        seq (str): a DNA sequence
+
+    Returns:
+        ndarray: uint8 code of each char, ACGT being 0 to 3
+    """
+    return SYMBOL_CODES[frombuffer(seq.encode(), dtype=uint8)]
+
+
+def word_codes(symbols: ndarray, length: int, bits: int) -> ndarray:
+    """Packs every word of a given length into an integer, first symbol in most significant bits
+
+    Words are built by doubling : words of length 2m are two words of length m side by side,
+    so packing costs a logarithmic number of operations in the word length.
+
+    Args:
+        symbols (ndarray): symbols, each fitting in the given number of bits
+        length (int): number of symbols per word
+        bits (int): number of bits per symbol
+
+    Returns:
+        ndarray: packed words, one per start position
+    """
+    words: ndarray | None = None
+    words_length: int = 0
+    power: ndarray = symbols.astype(uint64)
+    power_length: int = 1
+    while length:
+        if length & 1:
+            if words is None:
+                words, words_length = power, power_length
+            else:
+                number_words: int = max(
+                    len(symbols) - words_length - power_length + 1, 0)
+                words = (words[:number_words] << uint64(bits*power_length)) | \
+                    power[words_length:words_length+number_words]
+                words_length += power_length
+        length >>= 1
+        if length:
+            number_powers: int = max(len(symbols) - 2*power_length + 1, 0)
+            power = (power[:number_powers] << uint64(bits*power_length)) | \
+                power[power_length:power_length+number_powers]
+            power_length *= 2
+    return words
+
+
+def pattern_runs(pattern: list[int]) -> list[tuple[int, int]]:
+    """Lists the runs of kept positions of a pattern
+
+    Args:
+        pattern (list[int]): 110110... pattern, to select specific chars in kmer
+
+    Returns:
+        list[tuple[int, int]]: offset and length of each run of ones
+    """
+    runs: list[tuple[int, int]] = []
+    for offset, keep in enumerate(pattern):
+        if keep and runs and sum(runs[-1]) == offset:
+            runs[-1] = (runs[-1][0], runs[-1][1]+1)
+        elif keep:
+            runs.append((offset, 1))
+    return runs
+
+
+def extract_pattern(words: ndarray, pattern: list[int], bits: int) -> ndarray:
+    """Gathers the kept positions of a pattern from packed words, with a mask and a shift per run
+
+    Args:
+        words (ndarray): packed words, as long as the pattern
+        pattern (list[int]): 110110... pattern, to select specific chars in kmer
+        bits (int): number of bits per symbol
+
+    Returns:
+        ndarray: packed kept symbols
+    """
+    kept_after: int = sum(pattern)
+    extracted: ndarray | None = None
+    for offset, length in pattern_runs(pattern):
+        kept_after -= length
+        run: ndarray = words >> uint64(bits*(len(pattern)-offset-length))
+        run &= uint64((1 << bits*length) - 1)
+        if kept_after:
+            run <<= uint64(bits*kept_after)
+        if extracted is None:
+            extracted = run
+        else:
+            extracted |= run
+    return extracted
+
+
+def pattern_mask(pattern: list[int]) -> int:
+    """Computes the 1-bit mask of kept positions of a pattern, first position in most significant bit
+
+    Args:
+        pattern (list[int]): 110110... pattern, to select specific chars in kmer
+
+    Returns:
+        int: the bit mask
+    """
+    return sum(1 << (len(pattern)-i-1) for i, keep in enumerate(pattern) if keep)
+
+
+def kmer_codes(codes: ndarray, patterns: list[list[int]]) -> list[tuple[ndarray, ndarray, ndarray | None, ndarray | None]]:
+    """Computes the 2-bit codes of the kmers starting at each position, on both strands
+
+    Words as long as the widest pattern are packed once for the whole sequence,
+    then each pattern is applied as bit masks over them.
+
+    Args:
+        codes (ndarray): symbol codes of the sequence
+        patterns (list[list[int]]): 110110... patterns, to select specific chars in kmer
+
+    Returns:
+        list[tuple[ndarray, ndarray, ndarray | None, ndarray | None]]: for each pattern, forward codes,
+            reverse complement codes, and masks of kmers holding an ambiguous symbol on each strand
+            (None if the sequence is only made of ATCG)
+    """
+    span: int = max(len(pattern) for pattern in patterns)
+    # Padding with A, so that words are packed for every position of the sequence
+    padded: ndarray = concatenate([codes, zeros(span-1, dtype=uint8)])
+    # Sequences with ATCG only, by far the most common, skip all ambiguity handling
+    is_ambiguous: ndarray = padded > 3
+    has_ambiguity: bool = bool(is_ambiguous.any())
+    if has_ambiguity:
+        padded = padded & 3
+        ambiguous_words: ndarray = word_codes(is_ambiguous, span, 1)
+    forward_words: ndarray = word_codes(padded, span, 2)
+    reverse_words: ndarray = word_codes((3 - padded)[::-1], span, 2)[::-1]
+
+    kmers: list[tuple[ndarray, ndarray, ndarray | None, ndarray | None]] = []
+    for pattern in patterns:
+        number_kmers: int = max(len(codes) - len(pattern) + 1, 0)
+        # Shorter patterns read the first symbols of forward words, the last ones of reverse words
+        forward: ndarray = extract_pattern(
+            forward_words[:number_kmers] >> uint64(2*(span-len(pattern))), pattern, 2).view(int64)
+        reverse: ndarray = extract_pattern(
+            reverse_words[:number_kmers], pattern, 2).view(int64)
+        if has_ambiguity:
+            ambiguous: ndarray = ambiguous_words[:number_kmers] >> uint64(
+                span-len(pattern))
+            kmers.append((
+                forward,
+                reverse,
+                (ambiguous & uint64(pattern_mask(pattern))) > 0,
+                (ambiguous & uint64(pattern_mask(pattern[::-1]))) > 0
+            ))
+        else:
+            kmers.append((forward, reverse, None, None))
+    return kmers
+
+
+def homopolymers(ksize: int) -> ndarray:
+    """Codes of the AAA..., CCC..., GGG... and TTT... kmers
+
+    Args:
+        ksize (int): k size
+
+    Returns:
+        ndarray: the four codes
+    """
+    return arange(4, dtype=int64) * ((4**ksize - 1) // 3)
+
+
+def window_starts(length: int, window_size: int, max_sampling: int) -> ndarray:
+    """Computes where subreads begin inside a lecture
+
+    Args:
+        length (int): length of the DNA sequence
+        window_size (int): size of splits
+        max_sampling (int): maximum number of samples inside lecture
+
+    Raises:
+        ValueError: if read is too short
+
+    Returns:
+        ndarray: start position of each subread
+    """
+    if length < window_size:
+        raise ValueError("Read is too short.")
+    return arange(max_sampling, dtype=int64) * int((length-window_size)/max_sampling)
+
+
+def expand_kmer(symbols: ndarray) -> ndarray:
+    """Lists all ATCG kmers a kmer with ambiguous symbols may stand for
+
+    Args:
+        symbols (ndarray): symbol codes of the kmer
+
+    Returns:
+        ndarray: 2-bit codes of all possible ATCG kmers
+    """
+    expanded: ndarray = zeros(1, dtype=int64)
+    for symbol in symbols:
+        expanded = ((expanded[:, None] << 2) |
+                    EXPANSIONS[symbol][None, :]).ravel()
+    return expanded
+
+
+def count_blocks(strands: list[tuple[ndarray, ndarray]], first_block: int, number_blocks: int, ksize: int) -> tuple[ndarray, ndarray, ndarray]:
+    """Counts the kmers of consecutive blocks into their distinct codes
+
+    Small kmer spaces are counted densely with bincount, a chunk of blocks at a time,
+    larger ones by sorting the codes of each block. Homopolymers are never counted.
+
+    Args:
+        strands (list[tuple[ndarray, ndarray]]): kmer codes of each strand, and the block of each of
+            them counted from the first one of the run, in increasing order
+        first_block (int): first block of the run
+        number_blocks (int): number of blocks of the run
+        ksize (int): k size, codes being below 4^k
+
+    Returns:
+        tuple[ndarray, ndarray, ndarray]: block, code and count of each distinct kmer of each block,
+            in increasing order of block then code
+    """
+    space: int = 4**ksize
+    excluded: ndarray = homopolymers(ksize)
+    number_codes: int = sum(len(codes) for codes, _ in strands)
+    if number_blocks * space <= DENSE_RATIO * number_codes:
+        ids: list[ndarray] = []
+        kmers: list[ndarray] = []
+        occurrences: list[ndarray] = []
+        # Blocks are counted by chunks, so that no more than DENSE_CELLS counts are held at once
+        chunk: int = max(DENSE_CELLS // space, 1)
+        for chunk_start in range(0, number_blocks, chunk):
+            chunk_blocks: int = min(chunk, number_blocks - chunk_start)
+            dense: ndarray = zeros(chunk_blocks * space, dtype=int64)
+            for codes, blocks in strands:
+                if number_blocks == 1:
+                    # A subread alone in its run, as when subreads do not overlap
+                    dense += bincount(codes, minlength=space)
+                    continue
+                low, high = searchsorted(
+                    blocks, [chunk_start, chunk_start + chunk_blocks])
+                dense += bincount((blocks[low:high] - chunk_start) * space + codes[low:high],
+                                  minlength=chunk_blocks * space)
+            dense.reshape(chunk_blocks, space)[:, excluded] = 0
+            entries: ndarray = flatnonzero(dense)
+            ids.append(entries // space + first_block + chunk_start)
+            kmers.append(entries % space)
+            occurrences.append(dense[entries])
+        return concatenate(ids), concatenate(kmers), concatenate(occurrences)
+    if number_blocks * space < 2**63:
+        # Block and code packed in a single key, cheaper to sort than two keys
+        keys: ndarray = sort(concatenate(
+            [blocks * space + codes for codes, blocks in strands]))
+        firsts: ndarray = flatnonzero(concatenate(
+            [keys[:1] == keys[:1], keys[1:] != keys[:-1]]))
+        ids, kmers = keys[firsts] // space + first_block, keys[firsts] % space
+    else:
+        codes: ndarray = concatenate([codes for codes, _ in strands])
+        blocks: ndarray = concatenate([blocks for _, blocks in strands])
+        order: ndarray = lexsort((codes, blocks))
+        codes, blocks = codes[order], blocks[order]
+        firsts: ndarray = flatnonzero(concatenate([codes[:1] == codes[:1], (
+            codes[1:] != codes[:-1]) | (blocks[1:] != blocks[:-1])]))
+        ids, kmers = blocks[firsts] + first_block, codes[firsts]
+    occurrences: ndarray = diff(concatenate([firsts, [number_codes]])).astype(int64)
+    kept: ndarray = ~isin(kmers, excluded)
+    return ids[kept], kmers[kept], occurrences[kept]
+
+
+def merge_counts(codes: ndarray, counts: ndarray, blocks: ndarray | None = None, ksize: int | None = None) -> tuple[ndarray, ndarray]:
+    """Sums the counts of identical kmer codes
+
+    Args:
+        codes (ndarray): kmer codes, possibly repeated
+        counts (ndarray): count of each code
+        blocks (ndarray | None, optional): block of each code, distinct codes of a same block being
+            in increasing order. Defaults to None.
+        ksize (int | None, optional): k size, to sum densely when the kmer space is small. Defaults to None.
+
+    Returns:
+        tuple[ndarray, ndarray]: distinct codes in increasing order, and their summed counts
+    """
+    if blocks is not None and (not len(blocks) or blocks[0] == blocks[-1]):
+        # Codes of a single block are already distinct and sorted
+        return codes, counts
+    if ksize is not None and 4**ksize <= DENSE_RATIO * len(codes):
+        dense: ndarray = bincount(codes, weights=counts, minlength=4**ksize)
+        merged: ndarray = flatnonzero(dense)
+        return merged, dense[merged].astype(int64)
+    order: ndarray = argsort(codes, kind='stable')
+    sorted_codes: ndarray = codes[order]
+    firsts: ndarray = flatnonzero(concatenate(
+        [sorted_codes[:1] == sorted_codes[:1], sorted_codes[1:] != sorted_codes[:-1]]))
+    if not len(firsts):
+        return zeros(0, dtype=int64), zeros(0, dtype=int64)
+    return sorted_codes[firsts], add.reduceat(counts[order], firsts)
+
+
+def ambiguous_counts(codes: ndarray, forward_starts: ndarray, reverse_starts: ndarray, pattern: list[int], n_policy: str = 'expand') -> tuple[ndarray, ndarray]:
+    """Spreads kmers holding ambiguous chars over the ATCG kmers they may stand for
+
+    Args:
+        codes (ndarray): symbol codes of the sequence
+        forward_starts (ndarray): positions of ambiguous kmers on forward strand
+        reverse_starts (ndarray): positions of ambiguous kmers on reverse strand
+        pattern (list[int]): 110110... pattern, to select specific chars in kmer
+        n_policy (str, optional): how kmers holding a N are counted. Defaults to 'expand'.
+
+    Returns:
+        tuple[ndarray, ndarray]: codes of ATCG kmers and counts to add to them, codes being possibly repeated
+    """
+    kept: ndarray = flatnonzero(pattern)
+    # Symbols of each kmer, reverse ones being complemented and read from the end of the pattern
+    symbols: ndarray = concatenate([
+        codes[forward_starts[:, None] + kept],
+        COMPLEMENT_CODES[codes[reverse_starts[:, None] + len(pattern) - 1 - kept]]
+    ])
+    # Kmers spanning two contigs are dropped whatever the policy
+    keys, occurrences = unique(
+        symbols[(symbols != JUNCTION).all(axis=1)], axis=0, return_counts=True)
+    added: list[tuple[ndarray, ndarray]] = []
+    weighted: list[tuple[ndarray, ndarray]] = []
+    unknown: int = ALPHABET.index('N')
+    for key, count in zip(keys, occurrences):
+        if n_policy == 'skip' and (key == unknown).any():
+            continue
+        number_expanded: int = prod([len(EXPANSIONS[symbol]) for symbol in key.tolist()])
+        if n_policy == 'split-weight' and (key == unknown).any():
+            # Keys giving less than half a count to each kmer are not expanded, their weights being
+            # almost always rounded away : long N runs cost nothing
+            if 2 * count >= number_expanded:
+                weighted.append((expand_kmer(key), full(number_expanded, count/number_expanded)))
+        elif count >= number_expanded:
+            # We divide count by the number of keys we end up with to normalize,
+            # kmers seen less often than they expand would add nothing and are not expanded
+            added.append((expand_kmer(key), full(number_expanded, count//number_expanded, dtype=int64)))
+    if weighted:
+        # Weights are summed for each kmer before being rounded
+        weight_codes, inverse = unique(concatenate(
+            [expanded for expanded, _ in weighted]), return_inverse=True)
+        added.append((weight_codes, rint(bincount(inverse, weights=concatenate(
+            [weights for _, weights in weighted]))).astype(int64)))
+    if not added:
+        return zeros(0, dtype=int64), zeros(0, dtype=int64)
+    return concatenate([expanded for expanded, _ in added]), concatenate([counts for _, counts in added])
+
+
+def count_windows(codes: ndarray, patterns: list[list[int]], starts: ndarray, window_size: int, n_policy: str = 'expand') -> list[csr_matrix]:
+    """Counts kmers of many subreads of a same sequence, for many patterns at once
+
+    Subread boundaries cut the sequence into blocks, each block being counted once
+    into its distinct kmer codes and their counts. Blocks are stored one after the other,
+    so that the blocks of a subread are a contiguous slice, merged into its counts :
+    overlapping subreads never encode the same bases twice, and dense rows of the
+    kmer space are only built when it is small next to the blocks, see count_blocks.
+
+    Args:
+        codes (ndarray): symbol codes of the sequence
+        patterns (list[list[int]]): 110110... patterns, to select specific chars in kmer
+        starts (ndarray): start position of each subread
+        window_size (int): size of subreads
+        n_policy (str, optional): how kmers holding a N are counted. Defaults to 'expand'.
+
+    Returns:
+        list[csr_matrix]: for each pattern, sparse counts of kmers, one row per subread
+    """
+    span: int = max(len(pattern) for pattern in patterns)
+    # Last two kmers of each subread are not counted, as it always has been
+    ends: list[ndarray] = [starts + max(window_size-len(pattern)-1, 0)
+                           for pattern in patterns]
+    boundaries: ndarray = unique(concatenate([starts, *ends]))
+    # Number of subreads covering the block that begins at each boundary, for the shortest pattern
+    coverage: ndarray = searchsorted(sort(starts), boundaries, side='right') - \
+        searchsorted(sort(starts + max(window_size-min(len(pattern)
+                     for pattern in patterns)-1, 0)), boundaries, side='right')
+
+    # Distinct codes of each block and their counts, blocks in increasing order
+    block_ids: list[list[ndarray]] = [[] for _ in patterns]
+    block_codes: list[list[ndarray]] = [[] for _ in patterns]
+    block_counts: list[list[ndarray]] = [[] for _ in patterns]
+    forward_positions: list[list[ndarray]] = [[] for _ in patterns]
+    reverse_positions: list[list[ndarray]] = [[] for _ in patterns]
+    # Consecutive covered blocks are merged into runs, whose kmers are encoded at once
+    covered: ndarray = flatnonzero(coverage[:-1] > 0)
+    for run in split(covered, flatnonzero(diff(covered) > 1) + 1):
+        if not len(run):
+            continue
+        run_start, run_end = boundaries[run[0]], boundaries[run[-1]+1]
+        # Block each kmer of the run starts in, from the first block of the run
+        position_blocks: ndarray = repeat(
+            arange(len(run), dtype=int64), diff(boundaries[run[0]:run[-1]+2]))
+        for i, (forward, reverse, forward_ambiguous, reverse_ambiguous) in enumerate(kmer_codes(
+                codes[run_start:run_end+span-1], patterns)):
+            strands: list[tuple[ndarray, ndarray]] = [
+                (forward[:run_end-run_start], position_blocks), (reverse[:run_end-run_start], position_blocks)]
+            if forward_ambiguous is not None:
+                # Ambiguous kmers are counted aside, subread by subread
+                strands = [(strand_codes[~ambiguous[:run_end-run_start]], position_blocks[~ambiguous[:run_end-run_start]])
+                           for (strand_codes, _), ambiguous in zip(strands, [forward_ambiguous, reverse_ambiguous])]
+                forward_positions[i].append(
+                    flatnonzero(forward_ambiguous[:run_end-run_start]) + run_start)
+                reverse_positions[i].append(
+                    flatnonzero(reverse_ambiguous[:run_end-run_start]) + run_start)
+            ids, kmers, occurrences = count_blocks(
+                strands, run[0], len(run), sum(patterns[i]))
+            block_ids[i].append(ids)
+            block_codes[i].append(kmers)
+            block_counts[i].append(occurrences)
+
+    all_counts: list[csr_matrix] = []
+    for i, pattern in enumerate(patterns):
+        ids: ndarray = concatenate(block_ids[i] or [zeros(0, dtype=int64)])
+        kmers: ndarray = concatenate(block_codes[i] or [zeros(0, dtype=int64)])
+        occurrences: ndarray = concatenate(
+            block_counts[i] or [zeros(0, dtype=int64)])
+        # First entry of each block, so that entries of blocks a to b are a slice
+        offsets: ndarray = searchsorted(ids, arange(len(boundaries)))
+        forward_ambiguous_positions: ndarray = concatenate(
+            forward_positions[i] or [zeros(0, dtype=int64)])
+        reverse_ambiguous_positions: ndarray = concatenate(
+            reverse_positions[i] or [zeros(0, dtype=int64)])
+
+        rows: list[tuple[ndarray, ndarray]] = []
+        for start, end in zip(starts, ends[i]):
+            first, last = offsets[searchsorted(boundaries, start)], offsets[searchsorted(boundaries, end)]
+            window_codes, window_counts = merge_counts(
+                kmers[first:last], occurrences[first:last], ids[first:last], sum(pattern))
+            # We treat cases where sequence alphabet is not ATCG, subread by subread
+            forward_starts: ndarray = forward_ambiguous_positions[searchsorted(
+                forward_ambiguous_positions, start):searchsorted(forward_ambiguous_positions, end)]
+            reverse_starts: ndarray = reverse_ambiguous_positions[searchsorted(
+                reverse_ambiguous_positions, start):searchsorted(reverse_ambiguous_positions, end)]
+            if len(forward_starts) or len(reverse_starts):
+                extra_codes, extra_counts = ambiguous_counts(
+                    codes, forward_starts, reverse_starts, pattern, n_policy)
+                window_codes, window_counts = merge_counts(concatenate(
+                    [window_codes, extra_codes]), concatenate([window_counts, extra_counts]))
+                nonzero: ndarray = window_counts != 0
+                window_codes, window_counts = window_codes[nonzero], window_counts[nonzero]
+            rows.append((window_codes, window_counts))
+
+        indptr: ndarray = zeros(len(rows)+1, dtype=int64)
+        cumsum([len(window_codes) for window_codes, _ in rows], out=indptr[1:])
+        all_counts.append(csr_matrix((
+            concatenate([window_counts for _, window_counts in rows] or [zeros(0, dtype=int64)]),
+            concatenate([window_codes for window_codes, _ in rows] or [zeros(0, dtype=int64)]),
+            indptr
+        ), shape=(len(rows), 4**sum(pattern))))
+    return all_counts
+
+
+def counter(entry: str, pattern: list[int], n_policy: str = 'expand') -> ndarray:
+    """Counts all kmers and filter non-needed ones
+
+    Args:
+        entry (str): a subread
+        pattern (list[int]): 110110... pattern, to select specific chars in kmer
+        n_policy (str, optional): how kmers holding a N are counted. Defaults to 'expand'.
+
+    Returns:
+        ndarray: dense counts of kmers inside subread, indexed by kmer 2-bit code
+    """
+    return count_windows(sequence_codes(entry), [pattern], zeros(1, dtype=int64), len(entry), n_policy)[0].toarray()[0]
+
+
+def reverse_complement_codes(codes: ndarray, ksize: int) -> ndarray:
+    """Computes the 2-bit codes of the reverse complement of kmers
+
+    Args:
+        codes (ndarray): 2-bit codes of kmers
+        ksize (int): length of kmer
+
+    Returns:
+        ndarray: 2-bit codes of their reverse complements
+    """
+    reverse: ndarray = zeros(len(codes), dtype=int64)
+    for i in range(ksize):
+        reverse = (reverse << 2) | (3 - ((codes >> 2*i) & 3))
+    return reverse
+
+
+@lru_cache(maxsize=None)
+def canonical_columns(ksize: int) -> ndarray:
+    """Maps each kmer to the column of its canonical form, the smallest code of itself and its reverse complement
+
+    Canonical kmers are numbered in increasing order of code. Built once per kmer size and
+    process, as counts of every read and genome are folded with it.
+
+    Args:
+        ksize (int): length of kmer
+
+    Returns:
+        ndarray: column of each kmer code, read-only as it is shared between calls
+    """
+    codes: ndarray = arange(4**ksize, dtype=int64)
+    reverse: ndarray = reverse_complement_codes(codes, ksize)
+    ranks: ndarray = cumsum(codes <= reverse) - 1
+    columns: ndarray = ranks[minimum(codes, reverse)].astype(
+        int32 if number_canonical(ksize) < 2**31 else int64)
+    columns.setflags(write=False)
+    return columns
+
+
+def number_canonical(ksize: int) -> int:
+    """Counts the canonical kmers of a size, without listing them
+
+    Args:
+        ksize (int): length of kmer
+
+    Returns:
+        int: half of the kmers, palindromes (only for even sizes) being their own reverse complement
+    """
+    return (4**ksize + (4**(ksize//2) if ksize % 2 == 0 else 0)) // 2
+
+
+def fold_canonical(counts: csr_matrix, ksize: int) -> csr_matrix:
+    """Folds each kmer with its reverse complement into a single feature
+
+    Args:
+        counts (csr_matrix): sparse counts of kmers, one row per subread
+        ksize (int): length of kmer
+
+    Returns:
+        csr_matrix: summed counts of each canonical kmer, one row per subread
+    """
+    counts = csr_matrix(counts)
+    # Each kmer is sent to the column of its canonical form, palindromes being counted once
+    folded: csr_matrix = csr_matrix(
+        (counts.data, canonical_columns(ksize)[counts.indices], counts.indptr), shape=(counts.shape[0], number_canonical(ksize)))
+    folded.sum_duplicates()
+    return folded
+
+
+def feature_groups(params: dict) -> list[tuple[int, list[int]]]:
+    """Lists the kmer sizes and patterns to compute, as one or many can be given in parameters
+
+    Args:
+        params (dict): params global dict
+
+    Raises:
+        ValueError: if there is not exactly one pattern per kmer size
+
+    Returns:
+        list[tuple[int, list[int]]]: ksize and pattern of each feature group
+    """
+    if isinstance(params['ksize'], int):
+        return [(params['ksize'], params['pattern'])]
+    if len(params['ksize']) != len(params['pattern']) or not all(isinstance(pattern, list) for pattern in params['pattern']):
+        raise ValueError(
+            "Parameter file must give one pattern per kmer size.")
+    return list(zip(params['ksize'], params['pattern']))
+
+
+def validate_parameters(params: dict) -> bool:
+    "Lists all conditions where a set of parameters is valid, and accepts the creation if so"
+    return all(
+        [
+            # verifies that the pattern length respects ksize
+            all(sum(pattern) == ksize for ksize,
+                pattern in feature_groups(params)),
+            # verifies that a pattern-long word fits in 64 bits
+            all(len(pattern) <= 32 for _, pattern in feature_groups(params)),
+            # verifies that kmers holding a N have a known way to be counted
+            params.get('n_policy', 'expand') in N_POLICIES,
+        ]
+    )
+
+
+def feature_space(params: dict) -> dict:
+    """Describes the features computed with a set of parameters
+
+    Each feature group holds the counts of one kmer size and pattern,
+    groups being laid side by side in the feature columns.
+
+    Args:
+        params (dict): params global dict
+
+    Returns:
+        dict: kmer parameters of each group, its first column, and number of features they lead to,
+            along with the way reverse complements and N are counted
+    """
+    canonical: bool = params.get('canonical', False)
+    groups: list[dict] = []
+    offset: int = 0
+    for ksize, pattern in feature_groups(params):
+        number_features: int = number_canonical(ksize) if canonical else 4**ksize
+        groups.append({
+            'ksize': ksize,
+            'pattern': pattern,
+            'offset': offset,
+            'number_features': number_features
+        })
+        offset += number_features
+    return {
+        'groups': groups,
+        'canonical': canonical,
+        # Counts of kmers holding a N differ from a policy to another
+        'n_policy': params.get('n_policy', 'expand'),
+        'number_features': offset
+    }
+
+
+def count_features(codes: ndarray, params: dict) -> csr_matrix:
+    """Samples subreads inside a sequence and computes their features
+
+    All feature groups are counted in a single pass over the sequence.
+
+    Args:
+        codes (ndarray): symbol codes of the sequence
+        params (dict): params global dict
+
+    Returns:
+        csr_matrix: sparse features, one row per subread, feature groups side by side
+    """
+    groups: list[tuple[int, list[int]]] = feature_groups(params)
+    all_counts: list[csr_matrix] = count_windows(
+        codes,
+        [pattern for _, pattern in groups],
+        window_starts(
+            len(codes),
+            params['read_size'],
+            params['sampling']
+        ),
+        params['read_size'],
+        params.get('n_policy', 'expand')
+    )
+    if params.get('canonical', False):
+        all_counts = [fold_canonical(counts, ksize)
+                      for counts, (ksize, _) in zip(all_counts, groups)]
+    return all_counts[0] if len(all_counts) == 1 else hstack(all_counts, format='csr')
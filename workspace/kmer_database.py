@@ -0,0 +1,270 @@
+"Binary, memory-mappable storage of the reference windows counts"
+from json import load, dump
+from os import path
+from pathlib import Path
+from dataclasses import dataclass
+from numpy import ndarray, memmap, arange, argsort, array, empty, zeros, repeat, bincount, cumsum, diff, concatenate, uint32, int32, int64, dtype as np_dtype
+from scipy.sparse import csr_matrix
+
+LEVELS: list[str] = [
+    'domain',
+    'phylum',
+    'group',
+    'order',
+    'family'
+]
+
+
+def count_dtype(params: dict) -> str:
+    """Smallest unsigned type able to hold any count of a window
+
+    Forward and reverse complement counts are summed, and canonical folding sums
+    them once more, hence a k-mer may at most be counted four times per position.
+
+    Args:
+        params (dict): featurization parameters
+
+    Returns:
+        str: numpy name of the type
+    """
+    return 'uint16' if 4 * params['read_size'] <= 65535 else 'uint32'
+
+
+def sparse_rows(counters: csr_matrix | ndarray, count_type: str) -> tuple[ndarray, ndarray, ndarray]:
+    """Splits windows counts into CSR pieces
+
+    Args:
+        counters (csr_matrix | ndarray): (windows, features) counts
+        count_type (str): type the counts are stored as
+
+    Returns:
+        tuple[ndarray, ndarray, ndarray]: number of values per window, feature indexes and counts
+    """
+    counters = csr_matrix(counters)
+    counters.eliminate_zeros()
+    counters.sort_indices()
+    return (
+        diff(counters.indptr).astype(int64),
+        counters.indices.astype(uint32),
+        counters.data.astype(count_type)
+    )
+
+
+class DatabaseWriter:
+    """Streams the windows counts of reference genomes into a database folder
+
+    Counts are stored as a CSR matrix, in three raw binary files: `indptr` holds
+    for each window its start in `indices` (feature index) and `data` (count).
+    Labels for each taxonomic level are written once all genomes are known,
+    with an index giving the rows of each taxon, alongside a `header.json`
+    holding mappings, feature space and parameters.
+    """
+
+    def __init__(self, database_path: str, params: dict, features: dict) -> None:
+        Path(database_path).mkdir(parents=True, exist_ok=True)
+        self.database_path: str = database_path
+        self.params: dict = params
+        self.features: dict = features
+        self.count_type: str = count_dtype(params)
+        self.genomes: list[dict] = list()
+        self.number_rows: int = 0
+        self.number_values: int = 0
+        self.row_sizes: list[ndarray] = list()
+        self.indices_file = open(
+            path.join(database_path, 'indices.bin'), 'wb')
+        self.data_file = open(path.join(database_path, 'data.bin'), 'wb')
+
+    def add_genome(self, genome_path: str, taxonomy: dict, windows: tuple[ndarray, ndarray, ndarray], key: str | None = None) -> None:
+        """Appends the windows of a genome to the database
+
+        Args:
+            genome_path (str): reference genome the windows come from
+            taxonomy (dict): taxa of the genome at each level
+            windows (tuple[ndarray, ndarray, ndarray]): sizes, indices and counts of the windows, see sparse_rows
+            key (str | None, optional): content address of the windows. Defaults to None.
+        """
+        row_sizes, indices, counts = windows
+        counts.astype(self.count_type, copy=False).tofile(self.data_file)
+        indices.astype(uint32, copy=False).tofile(self.indices_file)
+        self.row_sizes.append(row_sizes)
+        self.genomes.append(
+            {
+                'path': genome_path,
+                'key': key,
+                'first_row': self.number_rows,
+                'number_rows': len(row_sizes),
+                **{level: taxonomy[level] for level in LEVELS}
+            }
+        )
+        self.number_rows += len(row_sizes)
+        self.number_values += len(indices)
+
+    def close(self, mappings: dict) -> str:
+        """Writes labels and header, finalizing the database
+
+        Args:
+            mappings (dict): codes for each taxa, grouped by level
+
+        Returns:
+            str: path to the database folder
+        """
+        self.indices_file.close()
+        self.data_file.close()
+        rows_per_genome: ndarray = array(
+            [genome['number_rows'] for genome in self.genomes], dtype=int64)
+        cumsum(concatenate([zeros(1, dtype=int64), *self.row_sizes])).tofile(
+            path.join(self.database_path, 'indptr.bin'))
+        for level in LEVELS:
+            (labels := repeat(
+                array([mappings[level][genome[level]]
+                      for genome in self.genomes], dtype=int32),
+                rows_per_genome
+            )).tofile(path.join(self.database_path, f'labels_{level}.bin'))
+            # Rows grouped by taxon, so that the rows of a taxon are a slice between two offsets
+            argsort(labels, kind='stable').astype(int64).tofile(
+                path.join(self.database_path, f'rows_{level}.bin'))
+            cumsum(concatenate([zeros(1, dtype=int64), bincount(labels, minlength=mappings[level]['number_taxa'])])).tofile(
+                path.join(self.database_path, f'offsets_{level}.bin'))
+        with open(path.join(self.database_path, 'header.json'), 'w', encoding='utf-8') as jwriter:
+            dump(
+                {
+                    'number_rows': self.number_rows,
+                    'number_values': self.number_values,
+                    'count_dtype': self.count_type,
+                    'mappings': mappings,
+                    'features': self.features,
+                    'params': self.params,
+                    'genomes': self.genomes
+                },
+                jwriter
+            )
+        return self.database_path
+
+
+@dataclass
+class Database:
+    "Memory-mapped view over a database folder"
+    path: str
+    header: dict
+    indptr: ndarray
+    indices: ndarray
+    data: ndarray
+    labels: dict[str, ndarray]
+    index: dict[str, tuple[ndarray, ndarray]]
+
+    @property
+    def mappings(self) -> dict:
+        "Codes for each taxa, grouped by level"
+        return self.header['mappings']
+
+    @property
+    def features(self) -> dict:
+        "Feature space the counts are expressed in"
+        return self.header['features']
+
+    @property
+    def number_rows(self) -> int:
+        "Number of windows stored"
+        return self.header['number_rows']
+
+    def taxon_rows(self, level: str, taxon: str) -> ndarray:
+        """Rows of the windows belonging to a taxon, read from the index
+
+        Args:
+            level (str): taxonomic level
+            taxon (str): name of the taxon at this level
+
+        Returns:
+            ndarray: sorted rows, empty if taxon is unknown
+        """
+        if (code := self.mappings[level].get(taxon)) is None or taxon == 'number_taxa':
+            return empty(0, dtype=int64)
+        rows, offsets = self.index[level]
+        return rows[offsets[code]:offsets[code+1]]
+
+    def row(self, index: int) -> tuple[ndarray, ndarray]:
+        """Reads a single window from disk
+
+        Args:
+            index (int): row of the window
+
+        Returns:
+            tuple[ndarray, ndarray]: feature indexes and counts of the window
+        """
+        start, end = self.indptr[index], self.indptr[index+1]
+        return self.indices[start:end], self.data[start:end]
+
+    def rows(self, selection: ndarray, columns: ndarray | None = None) -> csr_matrix:
+        """Gathers a set of windows as a sparse matrix over the whole feature space
+
+        Args:
+            selection (ndarray): rows of the windows
+            columns (ndarray | None, optional): features to keep, in this order. Defaults to None (all of them).
+
+        Returns:
+            csr_matrix: (windows, features) counts
+        """
+        starts: ndarray = self.indptr[selection]
+        sizes: ndarray = self.indptr[selection+1] - starts
+        indptr: ndarray = cumsum(concatenate([zeros(1, dtype=int64), sizes]))
+        # Position in the database of each value, windows being laid one after the other
+        positions: ndarray = arange(
+            indptr[-1], dtype=int64) + repeat(starts - indptr[:-1], sizes)
+        matrix: csr_matrix = csr_matrix(
+            (self.data[positions], self.indices[positions], indptr),
+            shape=(len(selection), self.features['number_features'])
+        )
+        return matrix if columns is None else matrix[:, columns]
+
+
+def map_array(file_path: str, data_type: str, length: int) -> ndarray:
+    """Opens a raw binary file as a read-only array
+
+    Args:
+        file_path (str): file to map
+        data_type (str): type of the stored values
+        length (int): number of stored values
+
+    Returns:
+        ndarray: memory-mapped array, or an empty one as empty files can't be mapped
+    """
+    if not length:
+        return empty(0, dtype=np_dtype(data_type))
+    return memmap(file_path, dtype=data_type, mode='r', shape=(length,))
+
+
+def load_database(database_path: str) -> Database:
+    """Attaches to a database folder without reading its counts
+
+    Args:
+        database_path (str): folder written by a DatabaseWriter
+
+    Returns:
+        Database: memory-mapped database
+    """
+    with open(path.join(database_path, 'header.json'), 'r', encoding='utf-8') as jreader:
+        header: dict = load(jreader)
+    return Database(
+        path=database_path,
+        header=header,
+        indptr=map_array(path.join(database_path, 'indptr.bin'),
+                         'int64', header['number_rows']+1),
+        indices=map_array(path.join(database_path, 'indices.bin'),
+                          'uint32', header['number_values']),
+        data=map_array(path.join(database_path, 'data.bin'),
+                       header['count_dtype'], header['number_values']),
+        labels={
+            level: map_array(path.join(database_path, f'labels_{level}.bin'),
+                             'int32', header['number_rows'])
+            for level in LEVELS
+        },
+        index={
+            level: (
+                map_array(path.join(database_path, f'rows_{level}.bin'),
+                          'int64', header['number_rows']),
+                map_array(path.join(database_path, f'offsets_{level}.bin'),
+                          'int64', header['mappings'][level]['number_taxa']+1)
+            )
+            for level in LEVELS
+        }
+    )
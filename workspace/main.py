@@ -2,17 +2,19 @@
 from argparse import ArgumentParser
 from sys import argv
 from os import walk, path
+from math import ceil
 from json import load, dump
-from pickle import dump as pdump, load as pload
 from pathlib import Path
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import cpu_count
 from rich.traceback import install
 from rich import print
-from treelib import Tree
 from Bio import SeqIO
-from tharospytools import futures_collector
 from workspace.create_database import build_database
-from workspace.create_model import make_model
-from workspace.create_prediction import prediction
+from workspace.create_model import attach_models, model_nodes, train_models
+from workspace.create_prediction import attach_taxonomy, worker_prediction
+from workspace.taxonomy import routing_tables, save_taxonomy
 
 
 parser: ArgumentParser = ArgumentParser(
@@ -39,6 +41,14 @@ parser_database.add_argument(
     default=f'{path.dirname(__file__)}/parameters_files/params.json'
 )
 
+parser_database.add_argument(
+    "-t",
+    "--threads",
+    help="Number of cores used to index genomes and train models",
+    type=int,
+    default=cpu_count()
+)
+
 parser_database.add_argument(
     "database_name",
     help="Name for database",
@@ -67,6 +77,14 @@ parser_prediction.add_argument(
     default=f'{path.dirname(__file__)}/parameters_files/params.json'
 )
 
+parser_prediction.add_argument(
+    "-t",
+    "--threads",
+    help="Number of cores used to predict batches of reads",
+    type=int,
+    default=cpu_count()
+)
+
 parser_prediction.add_argument(
     "database_name",
     help="Name for database",
@@ -109,7 +127,8 @@ def main() -> None:
             args.parameters,
             args.database_name,
             [path.abspath(path.join(dirpath, f)) for dirpath, _, filenames in walk(
-                args.input_folder) for f in filenames]
+                args.input_folder) for f in filenames],
+            args.threads
         )
         print(
             f"[dark_orange]Database sucessfully built @ {output_path}"
@@ -117,36 +136,29 @@ def main() -> None:
 
         phylo_tree.show()  # data_property='code'
 
-        nodes_per_level: dict = {level: [node.tag for node in list(phylo_tree.filter_nodes(
-            lambda x: phylo_tree.depth(x) == i))] for i, level in enumerate(['root', 'domain', 'phylum', 'group', 'order'], start=0)}
+        nodes_per_level: dict = routing_tables(phylo_tree).nodes_per_level(
+            ['root', 'domain', 'phylum', 'group', 'order'])
 
         print(
             "[dark_orange]Starting model creation"
         )
 
-        # Loading data => should be put in the main call to escape loading it at each iteration
-        with open(output_path, 'r', encoding='utf-8') as jdb:
-            datas = load(jdb)
-
-        retcodes: list = futures_collector(make_model, fargs := [(datas, output_path, taxonomic_level, target_taxa)
-                                                                 for taxonomic_level, targets in nodes_per_level.items() for target_taxa in targets])
-
-        for i, (model_path, config_path) in enumerate(retcodes):
-            _, _, taxonomic_level, target_taxa = fargs[i]
+        # Loading params file, to know if models are learnt per node or per level
+        with open(args.parameters, 'r', encoding='utf-8') as pfile:
+            layout: str = load(pfile).get('model_layout', 'node')
 
-            if model_path is not None and config_path is not None:
+        # Each worker attaches to the database once, tasks only carry the node to train
+        fargs: list = model_nodes(nodes_per_level, layout)
+        retcodes: list = train_models(output_path, fargs, args.threads)
 
-                try:
-                    node = phylo_tree[f"{target_taxa.lower()}_{taxonomic_level}"]
-                    node.data.model_path = model_path
-                    node.data.config_path = config_path
-                except KeyError:
-                    phylo_tree.remove_node(target_taxa.lower())
+        phylo_tree = attach_models(
+            phylo_tree, nodes_per_level, fargs, retcodes)
 
-        with open(phylo_path := f"{path.dirname(__file__)}/model/{args.database_name}_phylo_tree.txt", 'wb') as jtree:
-            pdump(phylo_tree, jtree)
+        save_taxonomy(
+            phylo_tree, taxonomy_path := f"{path.dirname(__file__)}/model/{args.database_name}_taxonomy.npz")
 
-        print(f"[dark_orange]Finished computing models, tree @ {phylo_path}")
+        print(
+            f"[dark_orange]Finished computing models, taxonomy @ {taxonomy_path}")
         exit(0)
 
     if args.subcommands == 'predict':
@@ -157,9 +169,8 @@ def main() -> None:
         with open(args.parameters, 'r', encoding='utf-8') as pfile:
             params: dict = load(pfile)
 
-        # Loading the phylogenetic tree
-        with open(phylo_path := f"{path.dirname(__file__)}/model/{args.database_name}_phylo_tree.txt", 'rb') as jtree:
-            tree: Tree = pload(jtree)
+        # Taxonomy is loaded once by each worker, when the pool starts
+        taxonomy_path: str = f"{path.dirname(__file__)}/model/{args.database_name}_taxonomy.npz"
 
         try:
             threshold: float = params["threshold"]
@@ -171,22 +182,27 @@ def main() -> None:
             raise RuntimeError(
                 "Invalid parameter file, must contain a read acceptance threshold value between 0.01 (1% identity) and 1.0 (100% identity).") from exc
 
-        # iterating over input files
-        for genome in [path.abspath(path.join(dirpath, f)) for dirpath, _, filenames in walk(
-                args.input_folder) for f in filenames]:
-
-            with open(genome, 'r', encoding='utf-8') as freader:
-                genome_data: dict = {fasta.id: str(fasta.seq)
-                                     for fasta in SeqIO.parse(freader, 'fasta')}
-
-            prediction_results: list = futures_collector(prediction, pargs := [
-                (id_sequence, dna_sequence, params, tree, threshold, args.parameters) for id_sequence, dna_sequence in genome_data.items()])
-
-            with open(report_path := path.join(args.output_folder, f"{Path(genome).stem}_job_output.json"), 'w', encoding='utf-8') as jwriter:
-                dump({identifier: prediction_results[i] for i, (identifier, _, _, _, _, _) in enumerate(
-                    pargs)}, jwriter)
-
-            print(
-                f"[dark_orange]Job on file {Path(genome).stem} ended sucessfully, report @ {report_path}"
-            )
+        with ProcessPoolExecutor(max_workers=args.threads, initializer=attach_taxonomy, initargs=(taxonomy_path,)) as executor:
+            # iterating over input files
+            for genome in [path.abspath(path.join(dirpath, f)) for dirpath, _, filenames in walk(
+                    args.input_folder) for f in filenames]:
+
+                with open(genome, 'r', encoding='utf-8') as freader:
+                    genome_data: dict = {fasta.id: str(fasta.seq)
+                                         for fasta in SeqIO.parse(freader, 'fasta')}
+
+                # Reads are predicted by batches, each model being called once per batch and level
+                identifiers: list[str] = list(genome_data)
+                # Small files are split so that every worker gets some reads
+                batch_size: int = max(1, min(params.get('prediction_batch', 10000), ceil(
+                    len(identifiers) / args.threads)))
+                prediction_results: list[dict] = list(executor.map(worker_prediction, [
+                    {id_sequence: genome_data[id_sequence] for id_sequence in identifiers[start:start+batch_size]} for start in range(0, len(identifiers), batch_size)], repeat(params), repeat(threshold), repeat(args.parameters)))
+
+                with open(report_path := path.join(args.output_folder, f"{Path(genome).stem}_job_output.json"), 'w', encoding='utf-8') as jwriter:
+                    dump({identifier: result for batch_results in prediction_results for identifier, result in batch_results.items()}, jwriter)
+
+                print(
+                    f"[dark_orange]Job on file {Path(genome).stem} ended sucessfully, report @ {report_path}"
+                )
         exit(0)
@@ -0,0 +1,146 @@
+"Taxa of the reference genomes, and tables to walk down their taxonomy"
+from os import path
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+from numpy import ndarray, array, int8, int32, savez_compressed, load as npload
+
+# treelib is only needed to build a taxonomy, predictions work from the saved tables
+if TYPE_CHECKING:
+    from treelib import Tree
+
+# Bumped whenever the layout of taxonomy files changes
+TAXONOMY_VERSION: int = 1
+
+
+@dataclass
+class Taxonomy:
+    "Modelizes a taxa level"
+    code: int | None
+    level: str
+    name: str
+    model_path: str | None
+    config_path: str | None
+
+
+@dataclass
+class Routing:
+    "Lookup tables to walk down the taxonomy, computed once from the tree"
+    # taxa at each depth, by name
+    taxa: list[dict[str, Taxonomy]]
+    # names of taxa at each depth, by code
+    names: list[dict[int, str]]
+    # codes of the children of each taxa, at each depth, by name
+    children: list[dict[str, list[int]]]
+
+    def nodes_per_level(self, levels: list[str]) -> dict[str, list[str]]:
+        "Names of the taxa at the depth of each given level, root being first"
+        return {level: list(self.taxa[i]) for i, level in enumerate(levels)}
+
+
+def column_map_path(model_path: str) -> str:
+    "File holding the features a pruned model has been learnt on"
+    return f"{path.splitext(model_path)[0]}_columns.npy"
+
+
+def routing_tables(tree: "Tree") -> Routing:
+    """Computes the routing tables of a taxonomy, in a single pass over its nodes
+
+    Args:
+        tree (Tree): taxonomy tree built with the database
+
+    Returns:
+        Routing: taxa, names and children codes at each depth
+    """
+    depths: dict[str, int] = dict()
+    routing: Routing = Routing([], [], [])
+    # Nodes are iterated in insertion order, a parent always being created before its children
+    for node in tree.all_nodes_itr():
+        depths[node.identifier] = depth = 0 if (parent := tree.parent(
+            node.identifier)) is None else depths[parent.identifier] + 1
+        if depth == len(routing.taxa):
+            routing.taxa.append(dict())
+            routing.names.append(dict())
+            routing.children.append(dict())
+        routing.taxa[depth][node.tag] = node.data
+        routing.names[depth][node.data.code] = node.tag
+        routing.children[depth][node.tag] = [
+            child.data.code for child in tree.children(node.identifier)]
+    return routing
+
+
+def save_taxonomy(tree: "Tree", taxonomy_path: str) -> None:
+    """Writes a taxonomy as flat arrays, a node being identified by its index
+
+    Nodes are listed in insertion order, so that parents come before their children.
+
+    Args:
+        tree (Tree): taxonomy tree, with its models attached
+        taxonomy_path (str): .npz file to write
+    """
+    nodes: list = list(tree.all_nodes_itr())
+    index: dict[str, int] = {node.identifier: i for i, node in enumerate(nodes)}
+    parents: list[int] = [-1 if (parent := tree.parent(node.identifier))
+                          is None else index[parent.identifier] for node in nodes]
+    depths: list[int] = []
+    for parent in parents:
+        depths.append(0 if parent < 0 else depths[parent] + 1)
+    # Plain arrays only, so that the file loads without unpickling anything
+    savez_compressed(
+        taxonomy_path,
+        version=array([TAXONOMY_VERSION], dtype=int32),
+        parents=array(parents, dtype=int32),
+        depths=array(depths, dtype=int8),
+        codes=array([node.data.code for node in nodes], dtype=int32),
+        levels=array([node.data.level for node in nodes], dtype=str),
+        names=array([node.tag for node in nodes], dtype=str),
+        model_paths=array(
+            [node.data.model_path or '' for node in nodes], dtype=str),
+        config_paths=array(
+            [node.data.config_path or '' for node in nodes], dtype=str)
+    )
+
+
+def read_taxonomy(taxonomy_path: str) -> dict[str, ndarray]:
+    """Reads back the arrays of a taxonomy file
+
+    Args:
+        taxonomy_path (str): .npz file written by save_taxonomy
+
+    Raises:
+        ValueError: if file has been written by another version of save_taxonomy
+
+    Returns:
+        dict[str, ndarray]: parents, depths, codes, levels, names, model and config paths of each node
+    """
+    with npload(taxonomy_path, allow_pickle=False) as taxonomy_file:
+        arrays: dict[str, ndarray] = dict(taxonomy_file)
+    if (version := int(arrays.pop('version')[0])) != TAXONOMY_VERSION:
+        raise ValueError(
+            f"Taxonomy file {taxonomy_path} has version {version}, expected {TAXONOMY_VERSION}. Models need to be built again.")
+    return arrays
+
+
+def load_taxonomy(taxonomy_path: str) -> Routing:
+    """Computes the routing tables of a taxonomy file, with no tree involved
+
+    Args:
+        taxonomy_path (str): .npz file written by save_taxonomy
+
+    Returns:
+        Routing: taxa, names and children codes at each depth
+    """
+    arrays: dict[str, ndarray] = read_taxonomy(taxonomy_path)
+    routing: Routing = Routing([], [], [])
+    for _ in range(int(arrays['depths'].max(initial=-1)) + 1):
+        routing.taxa.append(dict())
+        routing.names.append(dict())
+        routing.children.append(dict())
+    children: list[list[int]] = [[] for _ in arrays['parents']]
+    for node, (parent, depth, code, level, name, model_path, config_path) in enumerate(zip(*[arrays[key].tolist() for key in ['parents', 'depths', 'codes', 'levels', 'names', 'model_paths', 'config_paths']])):
+        routing.taxa[depth][name] = Taxonomy(
+            code, level, name, model_path or None, config_path or None)
+        routing.names[depth][code] = name
+        routing.children[depth][name] = children[node]
+        if parent >= 0:
+            children[parent].append(code)
+    return routing
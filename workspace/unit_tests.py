@@ -1,14 +1,330 @@
 from unittest import TestCase
+from unittest.mock import patch
+from collections import Counter
+from concurrent.futures import Future
 from subprocess import call
-from create_database import pattern_filter, taxonomy_information
+from tempfile import TemporaryDirectory
+from gzip import open as gzip_open
+from json import dump
+from hashlib import sha256
+from numpy import amax, argmax, array, array_equal, atleast_1d, bincount, concatenate, cumsum, mean, sort, uint64, load as npload
+from numpy.random import default_rng
+from os import listdir, mkdir, path, stat
+from shutil import copyfile, rmtree
+from sys import executable
+from create_database import featurize_genome, featurized_genomes, genome_key, taxonomy_information
+from kmer_counting import canonical_columns, counter, count_features, count_windows, decode_kmer, encode_kmer, expand_kmer, extract_pattern, feature_space, fold_canonical, pattern_mask, sequence_codes, window_starts
+from fasta_reader import genome_codes, read_fasta
+from kmer_database import DatabaseWriter, load_database, sparse_rows
+from taxonomy import Routing, Taxonomy, column_map_path, load_taxonomy, routing_tables, save_taxonomy
+from create_prediction import PINNED_BOOSTERS, WORKER_BOOSTERS, batch_prediction, cached_booster, masked_prediction, prediction, routed_scores, score_windows, softmax
+from create_sample import build_batch
+from create_model import DatabaseBatches, can_warm_start, make_model, model_nodes, node_rows, read_manifest, train_models, update_rows
+from scipy.sparse import vstack
+from xgboost import DMatrix, train
+from treelib import Tree
+
+
+def random_sequence(rng, length: int, gc: float) -> str:
+    "Random DNA sequence with the given GC content"
+    return ''.join(rng.choice(list('ACGT'), size=length, p=[(1-gc)/2, gc/2, gc/2, (1-gc)/2]))
+
+
+def gc_booster(folder: str, params_path: str, name: str, rng) -> tuple[str, str]:
+    "Trains a tiny model telling AT-rich (class 0) from GC-rich (class 1) windows, returns its model and config paths"
+    sample, _ = build_batch(params_path, [random_sequence(
+        rng, 400, gc) for gc in [0.2, 0.8]*10])
+    labels: list[int] = [0, 1]*10
+    bst = train({'objective': 'multi:softprob', 'num_class': 2, 'max_depth': 2},
+                DMatrix(sample, label=[label for label in labels for _ in range(4)]), num_boost_round=5)
+    bst.save_model(model_path := path.join(folder, f"{name}.json"))
+    with open(config_path := path.join(folder, f"{name}_params.json"), 'w', encoding='utf-8') as writer:
+        writer.write(bst.save_config())
+    return model_path, config_path
+
+
+def synthetic_database(folder: str, genomes: list[tuple[str, str, float, int]], settings: dict | None = None, orders: dict[str, str] | None = None) -> str:
+    "Writes a database of random genomes, given by name, family, GC content and seed, families being in order O unless told otherwise"
+    params: dict = {'read_size': 100, 'ksize': 4,
+                    'pattern': [1, 1, 1, 1], 'sampling': 4, **(settings or dict())}
+    writer = DatabaseWriter(folder, params, feature_space(params))
+    families: list[str] = sorted({family for _, family, _, _ in genomes})
+    order_of: dict[str, str] = {family: (orders or dict()).get(family, 'O') for family in families}
+    for name, family, gc, seed in genomes:
+        sequence: str = random_sequence(default_rng(seed), 1000, gc)
+        writer.add_genome(f"{name}.fna", {'domain': 'D', 'phylum': 'P', 'group': 'G', 'order': order_of[family], 'family': family}, sparse_rows(
+            count_features(sequence_codes(sequence), params), 'uint16'), key=sha256(sequence.encode()).hexdigest())
+    return writer.close({**{level: {'number_taxa': 1, taxon: 0} for level, taxon in zip(['domain', 'phylum', 'group'], 'DPG')},
+                         'order': {'number_taxa': len(set(order_of.values())), **{order: code for code, order in enumerate(sorted(set(order_of.values())))}},
+                         'family': {'number_taxa': len(families), **{family: code for code, family in enumerate(families)}}})
 
 
 class TestDatabase(TestCase):
     "Tests on methods to index genomes for database"
 
     def test_apply_pattern(self):
-        "Tests if a pattern is applied"
-        self.assertEqual(pattern_filter("ATCAG", [1, 1, 0, 1, 1]), "ATAG")
+        "Tests if a pattern is applied on packed words"
+        words = array([encode_kmer("ATCAG"), encode_kmer("GGATT")], dtype=uint64)
+        self.assertEqual(extract_pattern(words, [1, 1, 0, 1, 1], 2).tolist(),
+                         [encode_kmer("ATAG"), encode_kmer("GGTT")])
+        self.assertEqual(pattern_mask([1, 1, 0, 1, 1]), 0b11011)
+
+    def test_encode_kmer(self):
+        "Tests if kmers are encoded as dense feature indexes"
+        self.assertEqual(encode_kmer("AAAA"), 0)
+        self.assertEqual(encode_kmer("ACGT"), 27)
+        self.assertEqual(encode_kmer("TTTT"), 255)
+        self.assertEqual(decode_kmer(encode_kmer("GATTACA"), 7), "GATTACA")
+
+    def test_count_kmers(self):
+        "Tests if kmers are counted on both strands"
+        counts = counter("AACGTA", [1, 1])
+        # AA is a homopolymer, AC and CG on forward, TT, GT and CG on reverse
+        self.assertEqual(
+            {int(code): int(counts[code]) for code in counts.nonzero()[0]},
+            {1: 1, 6: 2, 11: 1}
+        )
+
+    def test_count_ambiguous_kmers(self):
+        "Tests if ambiguous kmers are spread over the kmers they may stand for"
+        counts = counter("ARARAR", [1, 1])
+        # AR is seen twice and splits into AA and AG, YT into CT and TT
+        self.assertEqual(
+            {int(code): int(counts[code]) for code in counts.nonzero()[0]},
+            {0: 1, 2: 1, 7: 1, 15: 1}
+        )
+
+    def test_unknown_bases_policy(self):
+        "Tests if kmers holding a N are expanded, skipped or spread with weights"
+        self.assertEqual(counter("ANANANANAG", [1, 1], 'expand').sum(), 8)
+        self.assertEqual(counter("ANANANANAG", [1, 1], 'skip').sum(), 0)
+        self.assertEqual(counter("ANANANANAG", [1, 1], 'split-weight').sum(), 16)
+        # Models can't be asked with counts of another policy
+        params = {'ksize': 2, 'pattern': [1, 1]}
+        self.assertEqual(feature_space(params), feature_space({**params, 'n_policy': 'expand'}))
+        self.assertNotEqual(feature_space(params), feature_space({**params, 'n_policy': 'split-weight'}))
+
+    def test_split_weight_unknown_run(self):
+        "Tests if a run of N is not expanded by the split-weight policy, its weights rounding to nothing"
+        rng = default_rng(0)
+        sequence = random_sequence(rng, 5000, 0.5) + 'N' * 200 + random_sequence(rng, 5000, 0.5)
+        with patch('kmer_counting.expand_kmer', wraps=expand_kmer) as expanding:
+            counts = count_windows(sequence_codes(sequence), [[1] * 12], window_starts(len(sequence), 10000, 1), 10000, 'split-weight')[0]
+        self.assertEqual(expanding.call_count, 0)
+        self.assertEqual((counts != count_windows(sequence_codes(sequence), [[1] * 12], window_starts(
+            len(sequence), 10000, 1), 10000, 'skip')[0]).nnz, 0)
+
+    def test_count_spaced_kmers(self):
+        "Tests if spaced patterns are applied on both strands"
+        counts = counter("ACGTTAC", [1, 0, 1])
+        # ACG, CGT and GTT give AG, CT and GT, their reverse CGT, ACG and AAC give CT, AG and AC
+        self.assertEqual(
+            {int(code): int(counts[code]) for code in counts.nonzero()[0]},
+            {encode_kmer("AC"): 1, encode_kmer("AG"): 2,
+             encode_kmer("CT"): 2, encode_kmer("GT"): 1}
+        )
+
+    def test_count_many_patterns(self):
+        "Tests if many patterns counted in one pass give the same counts as one by one"
+        sequence = sequence_codes("GATTACAGATTRCAGGGTACCATNNNTACGATTACA" * 3)
+        patterns = [[1, 1, 1], [1, 1, 0, 1, 1], [1, 0, 0, 0, 1]]
+        starts = window_starts(len(sequence), 40, 12)
+        for pattern, counts in zip(patterns, count_windows(sequence, patterns, starts, 40)):
+            self.assertEqual(
+                counts.toarray().tolist(),
+                count_windows(sequence, [pattern], starts, 40)[0].toarray().tolist()
+            )
+
+    def test_feature_groups(self):
+        "Tests if many kmer sizes are laid side by side as feature groups"
+        sequence = sequence_codes("GATTACAGATTRCAGGGTACCATNNNTACGATTACA" * 3)
+        params = {'read_size': 40, 'sampling': 12,
+                  'ksize': [2, 3], 'pattern': [[1, 1], [1, 0, 1, 1]]}
+        space = feature_space(params)
+        self.assertEqual(space['number_features'], 16 + 64)
+        self.assertEqual([group['offset'] for group in space['groups']], [0, 16])
+        features = count_features(sequence, params)
+        self.assertEqual(
+            features[:, 16:].toarray().tolist(),
+            count_features(sequence, {**params, 'ksize': 3, 'pattern': [1, 0, 1, 1]}).toarray().tolist()
+        )
+
+    def test_count_overlapping_windows(self):
+        "Tests if counts merged from blocks give the same counts as counting each subread"
+        sequence = "GATTACAGATTRCAGGGTACCATNNNTACGATTACA" * 3
+        starts = window_starts(len(sequence), 40, 12)
+        counts = count_windows(sequence_codes(sequence), [[1, 1, 1]], starts, 40)[0].toarray()
+        for start, window_counts in zip(starts, counts):
+            self.assertEqual(
+                window_counts.tolist(),
+                counter(sequence[start:start+40], [1, 1, 1]).tolist()
+            )
+
+    def test_count_large_kmers(self):
+        "Tests if kmers are counted sparse, with no row spanning the whole kmer space"
+        sequence = "ACGGTCATTGCAGTTACAGC" * 5
+        counts = count_windows(sequence_codes(sequence), [[1] * 16], window_starts(len(sequence), 60, 2), 60)[0]
+        self.assertEqual(counts.shape, (2, 4**16))
+        # Sequence repeats every 20 bases : 20 distinct kmers per strand
+        self.assertEqual(counts.getnnz(axis=1).tolist(), [40, 40])
+        self.assertEqual(counts[0, encode_kmer("ACGGTCATTGCAGTTA")], 3)
+
+    def test_count_small_kmers(self):
+        "Tests if small kmer spaces are counted with bincount, no kmer code ever being sorted"
+        codes = sequence_codes(random_sequence(default_rng(0), 50000, 0.5))
+        # Subreads side by side, then overlapping
+        for sampling in [4, 40]:
+            params = {'read_size': 10000, 'ksize': 6,
+                      'pattern': [1] * 6, 'sampling': sampling}
+            with patch('kmer_counting.sort', wraps=sort) as sorting, patch('kmer_counting.lexsort', side_effect=AssertionError), patch('kmer_counting.argsort', side_effect=AssertionError):
+                counts = count_features(codes, params)
+            # Only subread starts are sorted
+            self.assertTrue(all(len(args[0]) <= sampling for args, _ in sorting.call_args_list))
+            with patch('kmer_counting.DENSE_CELLS', 4**6):
+                self.assertEqual((count_features(codes, params) != counts).nnz, 0)
+            with patch('kmer_counting.DENSE_RATIO', 0):
+                self.assertEqual((count_features(codes, params) != counts).nnz, 0)
+
+    def test_fold_canonical(self):
+        "Tests if kmers are folded with their reverse complement"
+        folded = fold_canonical(counter("AACGTA", [1, 1])[None, :], 2).toarray()[0]
+        # 10 canonical 2-mers : AA AC AG AT CA CC CG GA GC TA
+        self.assertEqual(len(folded), 10)
+        # AC and GT are folded together, CG is a palindrome
+        self.assertEqual(folded.tolist(), [0, 2, 0, 0, 0, 0, 2, 0, 0, 0])
+        # Columns are counted without listing kmers, and listed once per kmer size
+        for ksize in range(1, 8):
+            self.assertEqual(feature_space({'ksize': ksize, 'pattern': [1] * ksize, 'canonical': True})[
+                             'number_features'], canonical_columns(ksize).max() + 1)
+        self.assertIs(canonical_columns(5), canonical_columns(5))
+
+    def test_database_roundtrip(self):
+        "Tests if windows counts and labels are read back from a memory-mapped database"
+        taxonomy = {'domain': 'D', 'phylum': 'P',
+                    'group': 'G', 'order': 'O', 'family': 'F'}
+        with TemporaryDirectory() as tmp:
+            writer = DatabaseWriter(
+                tmp, {'read_size': 10}, {'number_features': 3})
+            writer.add_genome('a.fna', taxonomy, sparse_rows(
+                array([[0, 3, 0], [1, 0, 2]]), 'uint16'))
+            writer.add_genome('b.fna', {**taxonomy, 'family': 'E'}, sparse_rows(
+                array([[0, 0, 0]]), 'uint16'))
+            writer.close({level: {'number_taxa': 2, 'D': 0, 'P': 0, 'G': 0, 'O': 0, 'F': 0, 'E': 1}
+                          for level in taxonomy})
+            database = load_database(tmp)
+            self.assertEqual(database.number_rows, 3)
+            self.assertEqual([values.tolist() for values in database.row(1)],
+                             [[0, 2], [1, 2]])
+            self.assertEqual(len(database.row(2)[0]), 0)
+            self.assertEqual(database.labels['family'].tolist(), [0, 0, 1])
+            self.assertEqual(database.taxon_rows(
+                'family', 'E').tolist(), [2])
+            self.assertEqual(database.taxon_rows(
+                'domain', 'D').tolist(), [0, 1, 2])
+            self.assertEqual(database.rows(array([2, 0])).toarray().tolist(),
+                             [[0, 0, 0], [0, 3, 0]])
+
+    def test_read_fasta(self):
+        "Tests if gzipped records are read as codes, whatever their case"
+        with TemporaryDirectory() as tmp:
+            with gzip_open(genome := path.join(tmp, 'genome.fna.gz'), 'wt', encoding='utf-8') as fwriter:
+                fwriter.write(">first contig\nacgT\nNa\n>second\nTTu\n")
+            self.assertEqual(
+                [(identifier, codes.tolist())
+                 for identifier, codes in read_fasta(genome)],
+                [('first', [0, 1, 2, 3, 14, 0]), ('second', [3, 3, 3])]
+            )
+            self.assertEqual(len(genome_codes(genome)), 10)
+
+    def test_contig_junctions(self):
+        "Tests if kmers spanning two contigs are not counted"
+        with TemporaryDirectory() as tmp:
+            with open(genome := path.join(tmp, 'genome.fna'), 'w', encoding='utf-8') as fwriter:
+                fwriter.write(">one\nACACACAC\n>two\nGTGTGTGT\n")
+            codes = genome_codes(genome)
+            # CG would only be read across the junction of the two contigs
+            for n_policy in ['expand', 'skip', 'split-weight']:
+                window_counts = count_windows(
+                    codes, [[1, 1]], window_starts(len(codes), len(codes), 1), len(codes), n_policy)[0].toarray()[0]
+                self.assertEqual(window_counts[encode_kmer('CG')], 0)
+                self.assertGreater(window_counts[encode_kmer('AC')], 0)
+
+    def test_feature_cache(self):
+        "Tests if counts of a genome are read back from cache when it did not change"
+        params = {'read_size': 50, 'ksize': 2,
+                  'pattern': [1, 1], 'sampling': 2}
+        with TemporaryDirectory() as tmp:
+            with open(genome := path.join(tmp, 'genome.fna'), 'w', encoding='utf-8') as fwriter:
+                fwriter.write(">contig\n" + "GATTACA" * 20 + "\n")
+            key, counted = featurize_genome(genome, params, tmp)
+            self.assertIn(f"{key}.npz", listdir(tmp))
+            self.assertNotEqual(genome_key(genome, params), genome_key(
+                genome, {**params, 'ksize': 3, 'pattern': [1, 1, 1]}))
+            for cached, computed in zip(featurize_genome(genome, params, tmp)[1], counted):
+                self.assertEqual(cached.tolist(), computed.tolist())
+
+    def test_featurized_genomes(self):
+        "Tests if genomes counted by many workers are yielded in input order, and read back from cache on the next build"
+        params = {'read_size': 50, 'ksize': 3,
+                  'pattern': [1, 1, 1], 'sampling': 5}
+        rng = default_rng(0)
+        with TemporaryDirectory() as tmp:
+            # More genomes than in flight at once, of different sizes, one of them shorter than a window
+            genomes = []
+            for index, length in enumerate([400, 40, 900, 120, 650, 300, 75]):
+                with open(genome := path.join(tmp, f"genome_{index}.fna"), 'w', encoding='utf-8') as fwriter:
+                    fwriter.write(f">contig\n{random_sequence(rng, length, 0.5)}\n")
+                genomes.append(genome)
+            cache_dir = path.join(tmp, 'cache')
+            mkdir(cache_dir)
+            computed = list(featurized_genomes(genomes, params, 2, cache_dir))
+            self.assertEqual([genome for genome, _, _ in computed], genomes)
+            self.assertIsNone(computed[1][2])
+            for (genome, key, windows), (expected_key, expected) in zip(computed, [featurize_genome(genome, params) for genome in genomes]):
+                self.assertEqual(key, expected_key)
+                self.assertEqual(windows is None, expected is None)
+                for piece, expected_piece in zip(windows or (), expected or ()):
+                    self.assertEqual(piece.tolist(), expected_piece.tolist())
+            # Second build reads every genome from cache, no block being written again
+            written = {name: (stat(path.join(cache_dir, name)).st_ino, stat(path.join(cache_dir, name)).st_mtime_ns) for name in listdir(cache_dir)}
+            self.assertEqual(len(written), len(genomes))
+            cached = list(featurized_genomes(genomes, params, 2, cache_dir))
+            self.assertEqual({name: (stat(path.join(cache_dir, name)).st_ino, stat(path.join(cache_dir, name)).st_mtime_ns) for name in listdir(cache_dir)}, written)
+            for (genome, key, windows), (expected_genome, expected_key, expected) in zip(cached, computed):
+                self.assertEqual((genome, key, windows is None), (expected_genome, expected_key, expected is None))
+                for piece, expected_piece in zip(windows or (), expected or ()):
+                    self.assertEqual(piece.tolist(), expected_piece.tolist())
+
+    def test_routing_tables(self):
+        "Tests if taxa and children are found at the right depth of the taxonomy, and read back from file"
+        tree = Tree()
+        tree.create_node('Root', 'root_root',
+                         data=Taxonomy(0, 'Root', 'Root', None, None))
+        for genome in ['D_P_G_O_F_1.fna', 'D_P_G_O_E_2.fna', 'D_Q_G_O_F_3.fna']:
+            _, tree = taxonomy_information(genome, tree)
+        for code, node in enumerate(tree.all_nodes_itr()):
+            node.data.code = code
+        routing = routing_tables(tree)
+        self.assertEqual(routing.nodes_per_level(['root', 'domain', 'phylum']),
+                         {'root': ['Root'], 'domain': ['D'], 'phylum': ['P', 'Q']})
+        self.assertEqual(routing.names[2], {tree['p_phylum'].data.code: 'P',
+                                            tree['q_phylum'].data.code: 'Q'})
+        self.assertEqual(routing.children[4]['O'], [
+                         tree['f_family'].data.code, tree['e_family'].data.code])
+        self.assertEqual(routing.taxa[5]['E'].level, 'family')
+        with TemporaryDirectory() as tmp:
+            save_taxonomy(tree, taxonomy_path := path.join(
+                tmp, 'taxonomy.npz'))
+            loaded = load_taxonomy(taxonomy_path)
+            self.assertEqual(
+                (loaded.names, loaded.children), (routing.names, routing.children))
+            self.assertEqual([{name: vars(taxa) for name, taxa in level.items()} for level in loaded.taxa],
+                             [{name: vars(taxa) for name, taxa in level.items()} for level in routing.taxa])
+
+    def test_prediction_without_treelib(self):
+        "Tests if prediction modules import when treelib is not installed"
+        self.assertEqual(call(
+            [executable, '-c', "import sys; sys.modules['treelib'] = None; import create_prediction"]), 0)
 
     def test_extract_taxo(self):
         "Tests if a taxonomy is correctly extracted"
@@ -26,5 +342,309 @@ class TestDatabase(TestCase):
         )
 
 
+class TestPrediction(TestCase):
+    "Tests on methods to predict reads"
+
+    def test_batch_prediction(self):
+        "Tests if a batch of reads is predicted as each read on its own"
+        rng = default_rng(0)
+        with TemporaryDirectory() as tmp:
+            with open(params_path := path.join(tmp, 'params.json'), 'w', encoding='utf-8') as writer:
+                dump({'read_size': 100, 'ksize': 4,
+                     'pattern': [1, 1, 1, 1], 'sampling': 4}, writer)
+            model_path, config_path = gc_booster(tmp, params_path, 'gc', rng)
+            # Every taxa splits in an AT-rich and a GC-rich child, with the same model
+            levels = ['root', 'domain', 'phylum', 'group', 'order', 'family']
+            routing = Routing(
+                [{'Root': Taxonomy(0, 'root', 'Root', model_path, config_path)}] + [{f"{tag}{i}": Taxonomy(
+                    code, level, f"{tag}{i}", model_path, config_path) for code, tag in enumerate('AB')} for i, level in enumerate(levels[1:], start=1)],
+                [{0: 'Root'}] + [{code: f"{tag}{i}" for code, tag in enumerate('AB')}
+                                 for i in range(1, 6)],
+                [{'Root': [0, 1]}] + [{f"{tag}{i}": [0, 1] for tag in 'AB'} for i in range(1, 6)]
+            )
+            params = {'read_size': 100, 'ksize': 4, 'pattern': [1, 1, 1, 1], 'sampling': 4}
+            reads = {f"read_{i}": random_sequence(rng, length, gc) for i, (length, gc) in enumerate(
+                [(300, 0.2), (150, 0.8), (50, 0.5), (400, 0.5), (100, 0.8)])}
+            predicted = batch_prediction(reads, params, routing, 0.6, params_path)
+            self.assertEqual(predicted['read_2'], 'REJECTED')
+            self.assertIn('A1', predicted['read_0'][0]['Root'])
+            self.assertIn('B1', predicted['read_1'][0]['Root'])
+            self.assertEqual(predicted, {id_sequence: prediction(
+                id_sequence, dna_sequence, params, routing, 0.6, params_path) for id_sequence, dna_sequence in reads.items()})
+
+    def test_softmax(self):
+        "Tests if reads are discriminated over all windows at once as they were row by row"
+        def row_softmax(predictions, func: str, reads_threshold: float) -> list:
+            # Models of a single class give a single score per window, seen as a row of one class
+            predictions = [atleast_1d(a) for a in predictions]
+            if reads_threshold <= 0:
+                return [argmax(a) for a in predictions]
+            if func == 'delta_mean':
+                ret = [argmax(a) if amax(a)-mean(a) >
+                       reads_threshold else False for a in predictions]
+            else:
+                ret = [argmax(a) if amax(a) > (sum(a)-amax(a)) +
+                       reads_threshold else False for a in predictions]
+            return ret if not all(not p for p in ret) else row_softmax(predictions, func, reads_threshold-0.05)
+
+        rng = default_rng(0)
+        for predictions in [rng.dirichlet([0.3]*4, size=20), rng.dirichlet([0.3]*2, size=20), rng.random(20)]:
+            for func in ['delta_mean', 'delta_sum']:
+                for threshold in [0.2, 0.5, 0.8]:
+                    self.assertEqual(softmax(predictions, func, threshold),
+                                     row_softmax(predictions, func, threshold))
+
+    def test_cached_booster(self):
+        "Tests if least recently used models are evicted past the memory budget, pinned ones staying loaded"
+        WORKER_BOOSTERS.clear()
+        PINNED_BOOSTERS.clear()
+        self.addCleanup(WORKER_BOOSTERS.clear)
+        self.addCleanup(PINNED_BOOSTERS.clear)
+        with TemporaryDirectory() as tmp:
+            with open(params_path := path.join(tmp, 'params.json'), 'w', encoding='utf-8') as writer:
+                dump({'read_size': 100, 'ksize': 4,
+                     'pattern': [1, 1, 1, 1], 'sampling': 4}, writer)
+            model_path, config_path = gc_booster(
+                tmp, params_path, 'gc', default_rng(0))
+            models = [path.join(tmp, f"model_{i}.json") for i in range(4)]
+            for copied in models:
+                copyfile(model_path, copied)
+            # Room for two models
+            cache_size = 2.5 * path.getsize(model_path) / 2**20
+            first, _ = cached_booster(models[0], config_path, cache_size=cache_size)
+            cached_booster(models[1], config_path, cache_size=cache_size)
+            self.assertIs(cached_booster(
+                models[0], config_path, cache_size=cache_size)[0], first)
+            cached_booster(models[2], config_path, cache_size=cache_size)
+            self.assertEqual(list(WORKER_BOOSTERS), [models[0], models[2]])
+            pinned, _ = cached_booster(
+                models[3], config_path, pinned=True, cache_size=cache_size)
+            cached_booster(models[1], config_path, cache_size=cache_size)
+            self.assertEqual(list(WORKER_BOOSTERS), [models[2], models[1]])
+            self.assertIs(cached_booster(
+                models[3], config_path, cache_size=cache_size)[0], pinned)
+            self.assertNotIn(models[3], WORKER_BOOSTERS)
+            # Newest model is kept even when it does not fit
+            cached_booster(models[0], config_path, cache_size=0)
+            self.assertEqual(list(WORKER_BOOSTERS), [models[0]])
+            self.assertEqual(list(PINNED_BOOSTERS), [models[3]])
+
+
+class TestModel(TestCase):
+    "Tests on methods to learn and update models"
+
+    def test_can_warm_start(self):
+        "Tests if only models of a database with new genomes keep on boosting"
+        previous = {'genomes': [['a', 'F'], ['b', 'E']],
+                    'mappings': {'number_taxa': 2, 'E': 0, 'F': 1}, 'settings': 'settings'}
+        self.assertTrue(can_warm_start(
+            previous, {**previous, 'genomes': [['a', 'F'], ['c', 'F'], ['b', 'E']]}))
+        # Nothing new to learn
+        self.assertFalse(can_warm_start(previous, previous))
+        # Relabelled genome
+        self.assertFalse(can_warm_start(
+            previous, {**previous, 'genomes': [['a', 'F'], ['b', 'F'], ['c', 'F']]}))
+        # Removed genome
+        self.assertFalse(can_warm_start(
+            previous, {**previous, 'genomes': [['a', 'F'], ['c', 'E']]}))
+        # Changed mapping
+        self.assertFalse(can_warm_start(previous, {
+                         **previous, 'genomes': [['a', 'F'], ['b', 'E'], ['c', 'F']], 'mappings': {'number_taxa': 2, 'E': 1, 'F': 0}}))
+        # Changed parameters
+        self.assertFalse(can_warm_start(previous, {
+                         **previous, 'genomes': [['a', 'F'], ['b', 'E'], ['c', 'F']], 'settings': 'other'}))
+
+    def test_read_manifest(self):
+        "Tests if manifests are read back, and if fingerprints of older builds are ignored"
+        with TemporaryDirectory() as tmp:
+            self.assertIsNone(read_manifest(path.join(tmp, 'missing.fingerprint')))
+            with open(manifest_path := path.join(tmp, 'node.fingerprint'), 'w', encoding='utf-8') as writer:
+                writer.write(sha256(b'old').hexdigest())
+            self.assertIsNone(read_manifest(manifest_path))
+            with open(manifest_path, 'w', encoding='utf-8') as writer:
+                dump(manifest := {'genomes': [['a', 'F']], 'mappings': {
+                     'number_taxa': 1, 'F': 0}, 'settings': 'settings'}, writer)
+            self.assertEqual(read_manifest(manifest_path), manifest)
+
+    def test_update_rows(self):
+        "Tests if models are updated on all new windows and a sample of the already learnt ones"
+        with TemporaryDirectory() as tmp:
+            database = load_database(synthetic_database(
+                tmp, [('a', 'F', 0.2, 0), ('b', 'E', 0.8, 1), ('c', 'F', 0.3, 2), ('d', 'E', 0.7, 3)]))
+            genomes = database.header['genomes']
+            known_keys = {genomes[0]['key'], genomes[2]['key']}
+            for reservoir in [0.0, 0.5, 1.0]:
+                rows = update_rows(database, genomes, known_keys, reservoir)
+                self.assertEqual(rows.tolist(), sorted(set(rows.tolist())))
+                self.assertTrue(set(database.taxon_rows('family', 'E').tolist()) <= set(rows.tolist()))
+                self.assertEqual(len(known := set(rows.tolist()) - set(
+                    database.taxon_rows('family', 'E').tolist())), int(reservoir * 8))
+                self.assertTrue(known <= set(database.taxon_rows('family', 'F').tolist()))
+
+    def test_make_model_resume(self):
+        "Tests if a node is learnt again only when the genomes it learns from have changed"
+        genomes = [('a', 'F', 0.2, 0), ('b', 'E', 0.8, 1)]
+        with TemporaryDirectory() as tmp:
+            # Models are written next to the sources, in a folder named after the database
+            model_name = f"unit_tests_{path.basename(tmp)}"
+            self.addCleanup(rmtree, path.join(path.dirname(
+                path.abspath(__file__)), 'model', model_name), True)
+            model_path, config_path = make_model(load_database(synthetic_database(
+                path.join(tmp, 'first'), genomes)), model_name, 'order', 'O')
+            learnt = stat(model_path).st_mtime_ns
+            # Same genomes, featurized again
+            self.assertEqual(make_model(load_database(synthetic_database(
+                path.join(tmp, 'same'), genomes)), model_name, 'order', 'O'), (model_path, config_path))
+            self.assertEqual(stat(model_path).st_mtime_ns, learnt)
+            # Genome b sequenced again
+            make_model(load_database(synthetic_database(path.join(tmp, 'changed'), [
+                       ('a', 'F', 0.2, 0), ('b', 'E', 0.8, 2)])), model_name, 'order', 'O')
+            self.assertNotEqual(stat(model_path).st_mtime_ns, learnt)
+
+    def test_pruned_model(self):
+        "Tests if a pruned model keeps its column map, and predicts from it as the model learnt on all kmers"
+        genomes = [('a', 'F', 0.2, 0), ('b', 'E', 0.8, 1), ('c', 'F', 0.25, 2), ('d', 'E', 0.75, 3)]
+        with TemporaryDirectory() as tmp:
+            models = dict()
+            for name, settings in [('full', None), ('pruned', {'feature_pruning': {'features': 20}})]:
+                model_name = f"unit_tests_{path.basename(tmp)}_{name}"
+                self.addCleanup(rmtree, path.join(path.dirname(
+                    path.abspath(__file__)), 'model', model_name), True)
+                database = load_database(synthetic_database(
+                    path.join(tmp, name), genomes, settings))
+                models[name] = make_model(database, model_name, 'order', 'O')
+            self.assertFalse(path.exists(column_map_path(models['full'][0])))
+            columns = npload(column_map_path(models['pruned'][0]))
+            self.assertTrue(0 < len(columns) <= 20)
+            self.assertEqual(columns.tolist(), sorted(set(columns.tolist())))
+            self.assertTrue(array_equal(cached_booster(*models['pruned'])[1], columns))
+            rng = default_rng(4)
+            sample = vstack([count_features(sequence_codes(random_sequence(
+                rng, 400, gc)), database.header['params']) for gc in [0.15, 0.85, 0.2, 0.8]], format='csr')
+            predictions = {name: score_windows(*models[name], sample, database.features)[0].argmax(axis=1).tolist()
+                           for name in models}
+            self.assertEqual(predictions['pruned'], predictions['full'])
+            self.assertEqual(predictions['full'], [database.mappings['family'][family]
+                             for family in 'FEFE' for _ in range(4)])
+
+    def test_external_memory_model(self):
+        "Tests if a model learnt from batches of windows sees every window, and predicts as one learnt in memory"
+        genomes = [('a', 'F', 0.2, 0), ('b', 'E', 0.8, 1), ('c', 'F', 0.25, 2), ('d', 'E', 0.75, 3)]
+        seen = []
+
+        class RecordedBatches(DatabaseBatches):
+            "Keeps track of the rows of each batch"
+
+            def next(self, input_data):
+                seen.append(self.rows[self.position:self.position+self.batch_size])
+                return super().next(input_data)
+
+        with TemporaryDirectory() as tmp:
+            models = dict()
+            for name, settings in [('memory', None), ('external', {'external_memory': {'order': 7}})]:
+                model_name = f"unit_tests_{path.basename(tmp)}_{name}"
+                self.addCleanup(rmtree, path.join(path.dirname(
+                    path.abspath(__file__)), 'model', model_name), True)
+                database = load_database(synthetic_database(
+                    path.join(tmp, name), genomes, settings))
+                with patch('create_model.DatabaseBatches', RecordedBatches):
+                    models[name] = make_model(database, model_name, 'order', 'O')
+            # Each pass over the batches reads every window of the node once
+            rows = concatenate(seen)
+            self.assertEqual(sorted(set(rows.tolist())), node_rows(database, 'order', 'O').tolist())
+            self.assertEqual(len(set(bincount(rows).tolist())), 1)
+            rng = default_rng(4)
+            sample = vstack([count_features(sequence_codes(random_sequence(
+                rng, 400, gc)), database.header['params']) for gc in [0.15, 0.85, 0.2, 0.8]], format='csr')
+            predictions = {name: score_windows(*models[name], sample, database.features)[0].argmax(axis=1).tolist()
+                           for name in models}
+            self.assertEqual(predictions['external'], predictions['memory'])
+            self.assertEqual(predictions['memory'], [database.mappings['family'][family]
+                             for family in 'FEFE' for _ in range(4)])
+
+    def test_level_model(self):
+        "Tests if a model of a whole level, masked to the children of a taxon, routes reads as the model of the taxon"
+        self.assertEqual(model_nodes({'order': ['O', 'Q']}, 'level'), [('order', None)])
+        # Scores of taxa outside the children are ignored, even the best ones
+        self.assertEqual(masked_prediction(array([[0.1, 0.2, 0.6, 0.1], [0.3, 0.1, 0.5, 0.1]]), [
+                         0, 1], 'delta_mean', 0.1), [1, 0])
+        # AT-rich and GC-rich families in both orders, which only the parent taxon tells apart
+        genomes = [(f"{family}{seed}", family, gc, seed) for seed, (family, gc) in enumerate(
+            [('F', 0.2), ('E', 0.8), ('H', 0.2), ('I', 0.8)] * 2)]
+        with TemporaryDirectory() as tmp:
+            model_name = f"unit_tests_{path.basename(tmp)}"
+            self.addCleanup(rmtree, path.join(path.dirname(
+                path.abspath(__file__)), 'model', model_name), True)
+            database = load_database(synthetic_database(
+                tmp, genomes, {'sampling': 20}, {'F': 'O', 'E': 'O', 'H': 'Q', 'I': 'Q'}))
+            level_model = make_model(database, model_name, 'order', None)
+            rng = default_rng(4)
+            samples = [count_features(sequence_codes(random_sequence(rng, 400, gc)), database.header['params'])
+                       for gc in [0.15, 0.85, 0.2, 0.8]]
+            offsets = cumsum([0] + [sample.shape[0] for sample in samples])
+            sample = vstack(samples, format='csr')
+            reads = list(range(len(samples)))
+            level_scores, is_level_model = routed_scores(
+                *level_model, sample, offsets, reads, database.features)
+            self.assertTrue(is_level_model)
+            families = database.mappings['family']
+            for order, children in [('O', 'EF'), ('Q', 'HI')]:
+                codes = [families[child] for child in children]
+                node_scores, is_level_model = routed_scores(
+                    *make_model(database, model_name, 'order', order), sample, offsets, reads, database.features)
+                self.assertFalse(is_level_model)
+                for read in reads:
+                    routed = masked_prediction(level_scores[read], codes, 'delta_mean', 0.8)
+                    self.assertTrue(set(routed) <= set(codes) | {False})
+                    # Reads go down to the same children, windows being counted as in batch_prediction
+                    kept: list[set] = [{child for child, count in counts.items() if count > 0.6 * sum(counts.values())} for counts in [
+                        Counter(code for code in routed if code is not False),
+                        Counter(code for code in softmax(node_scores[read], 'delta_mean', 0.8) if code is not False)]]
+                    self.assertTrue(kept[1])
+                    self.assertEqual(kept[0], kept[1])
+
+
+    def test_train_models(self):
+        "Tests if largest jobs are submitted first, and if no more threads than cores are ever running"
+        submitted, flights = [], []
+
+        class RecordedExecutor:
+            "Runs nothing, keeps track of the jobs submitted and of the threads they hold"
+
+            def __init__(self, max_workers, initializer, initargs):
+                self.threads: dict[Future, int] = dict()
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                return False
+
+            def submit(self, function, database_path, level, taxon, threads):
+                submitted.append((level, taxon))
+                (future := Future()).set_result((level, taxon))
+                self.threads[future] = threads
+                flights.append(sum(self.threads.values()))
+                return future
+
+        def oldest_done(running, return_when):
+            "Ends the job submitted first, giving its threads back"
+            del executor.threads[future := next(iter(running))]
+            return {future}, set()
+
+        # Order O holds four genomes, Q two of them, the level model all of them
+        genomes = [(f"{family}{seed}", family, 0.5, seed) for seed, family in enumerate('EEEFHI')]
+        nodes = [('order', 'Q'), ('group', 'G'), ('order', None), ('order', 'O')]
+        with TemporaryDirectory() as tmp:
+            database_path = synthetic_database(tmp, genomes, orders={'H': 'Q', 'I': 'Q'})
+            executor = RecordedExecutor(4, None, ())
+            with patch('create_model.ProcessPoolExecutor', return_value=executor), patch('create_model.wait', oldest_done):
+                self.assertEqual(train_models(database_path, nodes, 4), nodes)
+        self.assertEqual(submitted, [('order', None), ('order', 'O'), ('group', 'G'), ('order', 'Q')])
+        # Cores are all busy at some point, never oversubscribed, and all given back at the end
+        self.assertLessEqual(max(flights), 4)
+        self.assertIn(4, flights)
+        self.assertFalse(executor.threads)
+
 if __name__ == "__main__":
     call("python -m unittest -v unit_tests.py", shell=True)